@@ -5,6 +5,9 @@ from trytond.pool import Pool
 from . import caldav
 from .calendar_ import *
 from .res import *
+from .outbox import *
+from .freebusy import *
+from .ir import *
 
 
 def register():
@@ -12,4 +15,8 @@ def register():
         Event,
         EventAttendee,
         User,
+        Outbox,
+        BusyPeriod,
+        Translation,
+        Lang,
         module='calendar_scheduling', type_='model')
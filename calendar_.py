@@ -1,25 +1,183 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from email.base64mime import body_encode
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
+from collections import OrderedDict
+import datetime
+import hashlib
 import logging
+import re
 
 import dateutil.tz
+import vobject
 
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
 from trytond.model import fields
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.sendmail import sendmail_transactional
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
 
+from .metrics import metrics
+from .res import normalize_email
+from .spool import Spool
+
 __all__ = ['Event', 'EventAttendee']
 __metaclass__ = PoolMeta
 tzlocal = dateutil.tz.tzlocal()
+tzutc = dateutil.tz.tzutc()
 
 logger = logging.getLogger(__name__)
 
 
+MIME_LAYOUTS = ('full', 'inline', 'attachment')
+_timezones = LRUDict(64)
+_date_ranges = LRUDict(1024)
+
+VOLATILE_PROPERTIES = (b'DTSTAMP', b'SEQUENCE', b'CREATED', b'LAST-MODIFIED',
+    b'METHOD')
+_ical_property = re.compile(b'[^;:]*')
+_volatile_params = re.compile(
+    b';(?:SCHEDULE-STATUS|SCHEDULE-AGENT)=(?:"[^"]*"|[^;:]*)', re.I)
+
+
+def get_timezone(name):
+    "Return the tzinfo for the timezone name or the local one"
+    if not name:
+        return tzlocal
+    if name not in _timezones:
+        _timezones[name] = dateutil.tz.gettz(name)
+    return _timezones[name]
+
+
+def format_date_range(dtstart, dtend, all_day, timezone, language,
+        date_format):
+    '''
+    Return the text describing the period from dtstart to dtend in timezone
+    for language
+    '''
+    Lang = Pool().get('ir.lang')
+
+    key = (dtstart, dtend, all_day, timezone, language, date_format)
+    if key in _date_ranges:
+        return _date_ranges[key]
+
+    tzevent = get_timezone(timezone)
+    start = dtstart.replace(tzinfo=tzlocal).astimezone(tzevent)
+    if dtend:
+        end = dtend.replace(tzinfo=tzlocal).astimezone(tzevent)
+    else:
+        end = None
+
+    date = Lang.strftime(start, language, date_format)
+    if not all_day:
+        date += ' ' + Lang.strftime(start, language, '%H:%M')
+        if dtend:
+            date += ' -'
+            if dtstart.date() != dtend.date():
+                date += ' ' + Lang.strftime(end, language, date_format)
+            date += ' ' + Lang.strftime(end, language, '%H:%M')
+    else:
+        if dtend and dtstart.date() != dtend.date():
+            date += ' - ' + Lang.strftime(end, language, date_format)
+    if timezone:
+        date += ' ' + timezone
+    _date_ranges[key] = date
+    return date
+
+
+@metrics.timed('create_msg')
+def build_msg(from_addr, to_header, subject, body, ical):
+    '''
+    Return the MIME message of the scheduling message
+
+    The iCalendar is serialized and encoded once and shared between the
+    parts of the layout configured by calendar_scheduling/mime_layout:
+    "full" has the text/calendar alternative and the invite.ics attachment,
+    "inline" only the alternative and "attachment" only the attachment.
+    An unknown layout is replaced by "full".
+    '''
+    layout = config.get('calendar_scheduling', 'mime_layout', default='full')
+    if layout not in MIME_LAYOUTS:
+        logger.warning('unknown calendar_scheduling/mime_layout "%s", '
+            'use "full"', layout)
+        layout = 'full'
+
+    data = ical.serialize()
+    if not isinstance(data, bytes):
+        data = data.encode('UTF-8')
+    payload = body_encode(data)
+    metrics.inc('calendar_scheduling_ical_bytes_total', len(data))
+
+    def ical_part(maintype, subtype, **params):
+        part = MIMEBase(maintype, subtype, charset='utf-8', **params)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.set_payload(payload)
+        return part
+
+    msg = MIMEMultipart()
+    msg['To'] = to_header
+    msg['From'] = from_addr
+    msg['Subject'] = subject
+
+    msg_body = MIMEBase('text', 'plain')
+    msg_body.set_payload(body.encode('UTF-8'), 'UTF-8')
+
+    if layout in ('full', 'inline'):
+        inner = MIMEMultipart('alternative')
+        inner.attach(msg_body)
+        inner.attach(ical_part('text', 'calendar', method=ical.method.value))
+        msg.attach(inner)
+    else:
+        msg.attach(msg_body)
+
+    if layout in ('full', 'attachment'):
+        attachment = ical_part('application', 'ics')
+        attachment.add_header('Content-Disposition', 'attachment',
+                filename='invite.ics', name='invite.ics')
+        msg.attach(attachment)
+
+    return msg
+
+
+def ical_fingerprint(ical):
+    '''
+    Return the hash of the content of the scheduling iCalendar which is
+    relevant for the attendees
+
+    The properties and parameters which change without the event being
+    edited are ignored.
+    '''
+    data = ical.serialize()
+    if not isinstance(data, bytes):
+        data = data.encode('UTF-8')
+    # unfold the content lines
+    data = data.replace(b'\r\n ', b'').replace(b'\r\n\t', b'')
+    digest = hashlib.sha1()
+    for line in data.split(b'\r\n'):
+        name = _ical_property.match(line).group(0).upper()
+        if name in VOLATILE_PROPERTIES:
+            continue
+        digest.update(_volatile_params.sub(b'', line))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def format_template(template, args):
+    "Format template like raise_user_error which ignores unused arguments"
+    try:
+        return template % args
+    except TypeError:
+        return template
+
+
 class Event:
     __name__ = 'calendar.event'
+    _subject_body_cache = Cache('calendar_event.subject_body',
+        context=False)
+    _render_cache = Cache('calendar_event.render', context=False)
     organizer_schedule_status = fields.Selection([
             ('', ''),
             ('1.0', '1.0'),
@@ -37,6 +195,9 @@ class Event:
             ('SERVER', 'Server'),
             ('CLIENT', 'Client'),
             ], 'Schedule Agent')
+    scheduling_fingerprint = fields.Char('Scheduling Fingerprint',
+        readonly=True)
+    busy_until = fields.DateTime('Busy Until', readonly=True, select=True)
 
     @staticmethod
     def default_organizer_schedule_agent():
@@ -113,73 +274,87 @@ class Event:
 
         return ical
 
-    def subject_body(self, type, owner):
+    @classmethod
+    def subject_body_template(cls, type, language):
+        '''
+        Return a dictionary with the translated strings needed to render the
+        message of type in language
+        '''
         Lang = Pool().get('ir.lang')
 
-        if not owner:
-            return "", ""
-        lang = owner.language
-        if not lang:
-            lang, = Lang.search([
-                    ('code', '=', 'en'),
-                    ], limit=1)
-
-        with Transaction().set_context(language=lang.code):
-            summary = self.summary
-            if not summary:
-                summary = self.raise_user_error('no_subject',
-                        raise_exception=False)
-
-        if self.timezone:
-            tzevent = dateutil.tz.gettz(self.timezone)
-        else:
-            tzevent = tzlocal
-        dtstart = self.dtstart.replace(tzinfo=tzlocal).astimezone(tzevent)
-        if self.dtend:
-            dtend = self.dtend.replace(tzinfo=tzlocal).astimezone(tzevent)
-        else:
-            dtend = None
-
-        date = Lang.strftime(dtstart, lang.code, lang.date)
-        if not self.all_day:
-            date += ' ' + Lang.strftime(dtstart, lang.code, '%H:%M')
-            if self.dtend:
-                date += ' -'
-                if self.dtstart.date() != self.dtend.date():
-                    date += ' ' + Lang.strftime(dtend, lang.code,
-                        lang.date)
-                date += ' ' + Lang.strftime(dtend, lang.code, '%H:%M')
-        else:
-            if self.dtend and self.dtstart.date() != self.dtend.date():
-                date += ' - ' + Lang.strftime(dtend, lang.code, lang.date)
-        if self.timezone:
-            date += ' ' + self.timezone
-
-        with Transaction().set_context(language=lang.code):
-            subject = self.raise_user_error(type + '_subject',
-                    (summary, date), raise_exception=False)
-            body = self.raise_user_error(type + '_body', (summary, ),
-                    raise_exception=False)
-            separator = self.raise_user_error('separator',
-                    raise_exception=False)
-            bullet = self.raise_user_error('bullet', raise_exception=False)
+        key = (type, language)
+        template = cls._subject_body_cache.get(key)
+        if template is not None:
+            return template
 
+        langs = Lang.search([
+                ('code', '=', language),
+                ], limit=1)
         fields_names = ['summary', 'dtstart', 'location', 'attendees']
         if type == 'cancel':
             fields_names.remove('attendees')
-        with Transaction().set_context(language=lang.code):
-            fields = self.fields_get(fields_names=fields_names)
-            fields['dtstart']['string'] = self.raise_user_error('when',
+        with Transaction().set_context(language=language):
+            fields = cls.fields_get(fields_names=fields_names)
+            fields['dtstart']['string'] = cls.raise_user_error('when',
                     raise_exception=False)
-        for field in fields_names:
+            template = {
+                'subject': cls.raise_user_error(type + '_subject',
+                    raise_exception=False),
+                'body': cls.raise_user_error(type + '_body',
+                    raise_exception=False),
+                'no_subject': cls.raise_user_error('no_subject',
+                    raise_exception=False),
+                'separator': cls.raise_user_error('separator',
+                    raise_exception=False),
+                'bullet': cls.raise_user_error('bullet',
+                    raise_exception=False),
+                'fields': [(f, fields[f]['string']) for f in fields_names],
+                }
+        if langs:
+            lang, = langs
+            template['date'] = lang.date
+            template['direction'] = lang.direction
+        else:
+            template['date'] = '%m/%d/%Y'
+            template['direction'] = 'ltr'
+        cls._subject_body_cache.set(key, template)
+        return template
+
+    @metrics.timed('subject_body')
+    def subject_body(self, type, owner, language=None):
+        if not owner:
+            return "", ""
+        if language is None:
+            language = owner.language and owner.language.code or 'en'
+        # The sequence and write date identify the revision of the event
+        key = (self.id, self.sequence, self.write_date, type, language,
+            owner.id, tuple(a.email for a in self.attendees))
+        render = self._render_cache.get(key)
+        if render is not None:
+            return render
+        template = self.subject_body_template(type, language)
+        separator = template['separator']
+        bullet = template['bullet']
+
+        summary = self.summary
+        if not summary:
+            summary = template['no_subject']
+
+        date = format_date_range(self.dtstart, self.dtend, self.all_day,
+            self.timezone, language, template['date'])
+
+        subject = format_template(template['subject'], (summary, date))
+        body = format_template(template['body'], (summary,))
+
+        for field, string in template['fields']:
             if field == 'attendees':
-                if lang.direction == 'ltr':
-                    body += fields['attendees']['string'] + separator + '\n'
+                if template['direction'] == 'ltr':
+                    body += string + separator + '\n'
                     body += bullet + owner.email + '\n'
                     for attendee in self.attendees:
                         body += bullet + attendee.email + '\n'
                 else:
-                    body += separator + fields['attendees']['string'] + '\n'
+                    body += separator + string + '\n'
                     body += owner.email + bullet + '\n'
                     for attendee in self.attendees:
                         body += attendee.email + bullet + '\n'
@@ -192,66 +367,193 @@ class Event:
                     value = self.location.name
                 else:
                     value = getattr(self, field)
-                if lang.direction == 'ltr':
-                    body += fields[field]['string'] + separator + ' ' \
-                        + value + '\n'
+                if template['direction'] == 'ltr':
+                    body += string + separator + ' ' + value + '\n'
                 else:
-                    body += value + ' ' + separator \
-                        + fields[field]['string'] + '\n'
+                    body += value + ' ' + separator + string + '\n'
+        self._render_cache.set(key, (subject, body))
         return subject, body
 
+    def recipient_languages(self, to_addrs, owner):
+        '''
+        Return the list of (language, emails) to render the messages to
+        to_addrs
+
+        The messages are in the language of the owner unless
+        calendar_scheduling/recipient_language is set, then the recipients
+        who are users get it in their language.
+        '''
+        User = Pool().get('res.user')
+
+        default = (owner and owner.language and owner.language.code
+            or 'en')
+        if not config.getboolean('calendar_scheduling', 'recipient_language',
+                default=False):
+            return [(default, list(to_addrs))]
+        index = User.calendar_notification_index(to_addrs)
+        languages = OrderedDict()
+        for email in to_addrs:
+            entry = index.get(normalize_email(email))
+            language = entry and entry[1] or default
+            languages.setdefault(language, []).append(email)
+        return list(languages.items())
+
+    def scheduling_msgs(self, type, owner, from_addr, to_addrs, ical):
+        '''
+        Return the list of (emails, message) of type to to_addrs with one
+        message per language
+        '''
+        msgs = []
+        for language, emails in self.recipient_languages(to_addrs, owner):
+            subject, body = self.subject_body(type, owner, language=language)
+            msgs.append((emails,
+                    self.create_msg(from_addr, emails, subject, body, ical)))
+        return msgs
+
     @staticmethod
     def create_msg(from_addr, to_addrs, subject, body, ical=None):
 
         if not to_addrs:
             return None
 
-        msg = MIMEMultipart()
-        msg['To'] = ', '.join(to_addrs)
-        msg['From'] = from_addr
-        msg['Subject'] = subject
-
-        inner = MIMEMultipart('alternative')
-
-        msg_body = MIMEBase('text', 'plain')
-        msg_body.set_payload(body.encode('UTF-8'), 'UTF-8')
-        inner.attach(msg_body)
-
-        attachment = MIMEBase('text', 'calendar',
-            method=ical.method.value)
-        attachment.set_payload(ical.serialize(), 'UTF-8')
-        inner.attach(attachment)
+        return build_msg(from_addr, ', '.join(to_addrs), subject, body, ical)
 
-        msg.attach(inner)
+    @classmethod
+    @metrics.timed('recipients')
+    def notification_preferences(cls, emails):
+        '''
+        Return a dictionary mapping the normalized emails of the users to
+        the set of notification types they disabled
+        '''
+        User = Pool().get('res.user')
 
-        attachment = MIMEBase('application', 'ics')
-        attachment.set_payload(ical.serialize(), 'UTF-8')
-        attachment.add_header('Content-Disposition', 'attachment',
-                filename='invite.ics', name='invite.ics')
+        preferences = {}
+        for email, entry in User.calendar_notification_index(emails).items():
+            if entry is not None:
+                _, _, flags = entry
+                preferences[email] = set(t for t, enabled in flags.items()
+                    if not enabled)
+        return preferences
 
-        msg.attach(attachment)
+    @classmethod
+    def notified_addrs(cls, to_addrs, type, preferences=None):
+        '''
+        Return to_addrs without the users who disabled notification of type
 
-        return msg
+        preferences is the result of notification_preferences for a set of
+        emails including to_addrs.
+        '''
+        to_addrs = list(set(to_addrs))
+        if preferences is None:
+            preferences = cls.notification_preferences(to_addrs)
+        return [a for a in to_addrs
+            if type not in preferences.get(normalize_email(a), ())]
 
-    def send_msg(self, from_addr, to_addrs, msg, type):
+    @metrics.timed('send_msg')
+    def send_msg(self, from_addr, to_addrs, msg, type, preferences=None):
         '''
         Send message and return the list of email addresses sent
         '''
-        User = Pool().get('res.user')
-
         if not to_addrs:
             return to_addrs
-        to_addrs = list(set(to_addrs))
+        to_addrs = self.notified_addrs(to_addrs, type,
+            preferences=preferences)
+        if to_addrs:
+            sendmail_transactional(from_addr, to_addrs, msg)
+        return to_addrs
 
-        users = User.search([
-                ('email', 'in', to_addrs),
-                ])
-        for user in users:
-            if not getattr(user, 'calendar_email_notification_' + type):
-                to_addrs.remove(user.email)
+    @metrics.timed('event2ical')
+    def scheduling_ical(self, method):
+        'Return the iCalendar of the scheduling message for method'
+        with Transaction().set_context(skip_schedule_agent=True):
+            ical = self.event2ical()
+        if not hasattr(ical, 'method'):
+            ical.add('method')
+        ical.method.value = method
+        return ical
 
-        sendmail_transactional(from_addr, to_addrs, msg)
-        return to_addrs
+    def series_ical(self, method, occurrences):
+        '''
+        Return the iCalendar of the series for method with the master and
+        the occurrences
+
+        The master is not included in a CANCEL as it would cancel the whole
+        series.
+        '''
+        ical = self.scheduling_ical(method)
+        for vevent in list(ical.vevent_list):
+            if method == 'CANCEL' or hasattr(vevent, 'recurrence_id'):
+                ical.remove(vevent)
+        for occurrence in occurrences:
+            ical.add(occurrence.scheduling_ical(method).vevent)
+        return ical
+
+    def schedule_msg(self, type, owner, to_addrs, from_addr=None, icals=None,
+            preferences=None, occurrences=None):
+        '''
+        Send or queue the message of type to to_addrs and return the
+        schedule status of the recipients
+
+        icals is a dictionary used to share the iCalendar per method between
+        the messages of the event. If occurrences is set, the message is
+        about those occurrences of the series.
+        '''
+        Outbox = Pool().get('calendar.scheduling.outbox')
+
+        if not to_addrs:
+            return None
+        if from_addr is None:
+            from_addr = owner.email
+        method = type == 'cancel' and 'CANCEL' or 'REQUEST'
+        metrics.inc('calendar_scheduling_messages_total', type=type)
+        metrics.inc('calendar_scheduling_recipients_total', len(to_addrs),
+            type=type)
+        if Outbox.enabled() and occurrences is None:
+            message = Outbox.enqueue(type, method, from_addr, to_addrs,
+                event=self, owner=owner)
+            if message is None and type == 'cancel':
+                # The invitation was never sent so nothing is scheduled
+                return None
+            metrics.inc('calendar_scheduling_status_total', status='1.0')
+            return '1.0'  # pending
+
+        if icals is None:
+            icals = {}
+        key = method
+        if occurrences is not None:
+            key = (method,) + tuple(o.id for o in occurrences)
+        if key not in icals:
+            if occurrences is not None:
+                icals[key] = self.series_ical(method, occurrences)
+            else:
+                icals[key] = self.scheduling_ical(method)
+        ical = icals[key]
+        if Outbox.enabled():
+            # Rendered now because the worker renders the whole series
+            for language, emails in self.recipient_languages(to_addrs,
+                    owner):
+                subject, body = self.subject_body(type, owner,
+                    language=language)
+                Outbox.enqueue(type, method, from_addr, emails, event=self,
+                    owner=owner, subject=subject, body=body, ical=ical,
+                    merge=False)
+            metrics.inc('calendar_scheduling_status_total', status='1.0')
+            return '1.0'  # pending
+
+        to_addrs = self.notified_addrs(to_addrs, type,
+            preferences=preferences)
+        sent = False
+        for emails, msg in self.scheduling_msgs(type, owner, from_addr,
+                to_addrs, ical):
+            if self.send_msg(from_addr, emails, msg, type,
+                    preferences=preferences):
+                sent = True
+        if sent:
+            status = '1.1'  # successfully sent
+        else:
+            status = '5.1'  # could not complete delivery
+        metrics.inc('calendar_scheduling_status_total', status=status)
+        return status
 
     def attendees_to_notify(self):
         if not self.calendar.owner:
@@ -268,12 +570,13 @@ class Event:
                 organizer = self.parent.organizer
                 owner = self.parent.calendar.owner
 
-        if organizer != owner.email:
+        organizer = normalize_email(organizer)
+        if not organizer or organizer != normalize_email(owner.email):
             return [], None
 
         to_notify = []
         for attendee in attendees:
-            if attendee.email == organizer:
+            if normalize_email(attendee.email) == organizer:
                 continue
             if (attendee.schedule_agent
                     and attendee.schedule_agent != 'SERVER'):
@@ -284,175 +587,290 @@ class Event:
 
     @classmethod
     def create(cls, vlist):
-        Attendee = Pool().get('calendar.event.attendee')
-        events = super(Event, cls).create(vlist)
+        pool = Pool()
+        Attendee = pool.get('calendar.event.attendee')
+        Outbox = pool.get('calendar.scheduling.outbox')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
+        # The attendees are indexed with their events
+        with Transaction().set_context(skip_busy_index=True):
+            events = super(Event, cls).create(vlist)
+        # The occurrences override the periods of their series
+        BusyPeriod.index_events(
+            events + [e.parent for e in events if e.parent])
 
         if Transaction().user == 0:
             # user is 0 means create is triggered by another one
             return events
 
+        notifications = []
         for event in events:
             to_notify, owner = event.attendees_to_notify()
-            if not to_notify:
-                continue
+            if to_notify:
+                notifications.append((event, to_notify, owner))
 
-            with Transaction().set_context(skip_schedule_agent=True):
-                ical = event.event2ical()
-            ical.add('method')
-            ical.method.value = 'REQUEST'
+        preferences = None
+        if not Outbox.enabled():
+            preferences = cls.notification_preferences(a.email
+                for _, to_notify, _ in notifications for a in to_notify)
 
+        for event, to_notify, owner in notifications:
             attendee_emails = [a.email for a in to_notify]
+            status = event.schedule_msg('new', owner, attendee_emails,
+                preferences=preferences)
+            Attendee.write(to_notify, {
+                    'status': 'needs-action',
+                    'schedule_status': status,
+                    })
 
-            subject, body = event.subject_body('new', owner)
-            msg = cls.create_msg(owner.email, attendee_emails, subject, body,
-                ical)
-            sent = event.send_msg(owner.email, attendee_emails, msg, 'new')
+        return events
 
-            vals = {'status': 'needs-action'}
-            if sent:
-                vals['schedule_status'] = '1.1'  # successfully sent
-            else:
-                vals['schedule_status'] = '5.1'  # could not complete delivery
-            Attendee.write(to_notify, vals)
+    def scheduling_actions(self, former_emails, former_from_addr, edited):
+        '''
+        Return the owner and the list of (type, from_addr, emails, attendees)
+        messages needed to notify the changes of the event given the emails
+        notified before the change
 
-        return events
+        attendees are the current attendees receiving the message.
+        '''
+        current_attendees, owner = self.attendees_to_notify()
+        owner_email = owner and owner.email
+        current_emails = set(a.email for a in current_attendees)
+        former_emails_set = set(former_emails)
+
+        actions = []
+        missing_emails = [e for e in former_emails if e not in current_emails]
+        actions.append(('cancel', former_from_addr, missing_emails, []))
+
+        new_attendees = [a for a in current_attendees
+            if a.email not in former_emails_set]
+        old_attendees = [a for a in current_attendees
+            if a.email in former_emails_set]
+        if edited and self.status == 'cancelled':
+            actions.append(('cancel', owner_email,
+                    [a.email for a in old_attendees], old_attendees))
+        elif edited:
+            actions.append(('update', owner_email,
+                    [a.email for a in old_attendees], old_attendees))
+        if self.status != 'cancelled':
+            actions.append(('new', owner_email,
+                    [a.email for a in new_attendees], new_attendees))
+        return owner, [a for a in actions if a[2]]
 
     @classmethod
     def write(cls, *args):
-        Attendee = Pool().get('calendar.event.attendee')
+        BusyPeriod = Pool().get('calendar.scheduling.busy')
 
         if Transaction().user == 0:
             # user is 0 means write is triggered by another one
             super(Event, cls).write(*args)
+            BusyPeriod.index_events(BusyPeriod.written_events(args))
+            return
+
+        size = config.getint('calendar_scheduling', 'write_chunk',
+            default=1000)
+        actions = iter(args)
+        chunks = OrderedDict()
+        positions = {}
+        for i, (events, values) in enumerate(zip(actions, actions)):
+            for event in events:
+                position = positions.setdefault(event.id, len(positions))
+                chunk = chunks.setdefault(position // size if size else 0,
+                    OrderedDict())
+                chunk.setdefault(i, ([], values))[0].append(event)
+        if len(chunks) <= 1:
+            cls.write_scheduling(*args)
             return
+        # All the actions of an event are in the same chunk so each chunk
+        # is snapshot, written and notified like a separate call
+        del positions
+        while chunks:
+            _, chunk = chunks.popitem(last=False)
+            chunk_args = []
+            for events, values in chunk.values():
+                chunk_args.extend((events, values))
+            cls.write_scheduling(*chunk_args)
+
+    @classmethod
+    def write_scheduling(cls, *args):
+        '''
+        Write the events and notify the attendees of the changes
+        '''
+        pool = Pool()
+        Attendee = pool.get('calendar.event.attendee')
+        Outbox = pool.get('calendar.scheduling.outbox')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
 
         actions = iter(args)
+        all_events = []
         events_edited = set()
         for events, values in zip(actions, actions):
-            for k in values:
-                if k != 'attendees':
-                    events_edited.update(events)
-                    break
-
-            # store old attendee info
-            event2former_emails = {}
-            former_organiser_mail = {}
-            former_organiser_lang = {}
-            for event in events:
-                to_notify, owner = event.attendees_to_notify()
-                event2former_emails[event.id] = [a.email for a in to_notify]
-                former_organiser_mail[event.id] = owner and owner.email
-                former_organiser_lang[event.id] = owner and owner.language \
-                    and owner.language.code
+            if any(k != 'attendees' for k in values):
+                events_edited.update(events)
+            all_events.extend(events)
+        # An event may be in many actions
+        all_events = cls.browse(list(OrderedDict.fromkeys(
+                    e.id for e in all_events)))
+
+        # store old attendee info
+        former = {}
+        for event in all_events:
+            to_notify, owner = event.attendees_to_notify()
+            former[event.id] = ([a.email for a in to_notify],
+                owner and owner.email)
+        former_fingerprints = {}
+        for sub_events in grouped_slice(
+                [e for e in all_events if e in events_edited]):
+            for data in cls.read([e.id for e in sub_events],
+                    ['scheduling_fingerprint']):
+                former_fingerprints[data['id']] = \
+                    data['scheduling_fingerprint']
+        for event in all_events:
+            if (event.id in former_fingerprints
+                    and not former_fingerprints[event.id]
+                    and former[event.id][0]):
+                former_fingerprints[event.id] = ical_fingerprint(
+                    event.scheduling_ical('REQUEST'))
 
         super(Event, cls).write(*args)
+        BusyPeriod.index_events(BusyPeriod.written_events(args))
+
+        notifications = []
+        emails = set()
+        fingerprints = {}
+        event2icals = {}
+        for event in all_events:
+            former_emails, former_from_addr = former[event.id]
+            edited = event in events_edited
+            if edited:
+                fingerprints[event.id] = None
+                if former_emails or event.attendees_to_notify()[0]:
+                    ical = event.scheduling_ical('REQUEST')
+                    fingerprint = ical_fingerprint(ical)
+                    fingerprints[event.id] = fingerprint
+                    event2icals[event.id] = {'REQUEST': ical}
+                    # Only volatile properties have been changed
+                    edited = fingerprint != former_fingerprints[event.id]
+            owner, messages = event.scheduling_actions(former_emails,
+                former_from_addr, edited)
+            if messages:
+                notifications.append((event, owner, messages))
+                emails.update(e for m in messages for e in m[2])
+
+        preferences = None
+        if not Outbox.enabled():
+            preferences = cls.notification_preferences(emails)
+
+        cls.store_scheduling_fingerprints(dict((i, f)
+                for i, f in fingerprints.items()
+                if f is None or f != former_fingerprints[i]))
+
+        to_write = {}
+        series = OrderedDict()
+        for event, owner, messages in notifications:
+            if event.parent:
+                # The occurrences of a series are notified together
+                for type, from_addr, to_addrs, attendees in messages:
+                    recipients = series.setdefault(
+                        (event.parent, owner, type, from_addr), OrderedDict())
+                    email2attendees = {}
+                    for attendee in attendees:
+                        email2attendees.setdefault(attendee.email,
+                            []).append(attendee)
+                    for email in to_addrs:
+                        occurrences, email_attendees = recipients.setdefault(
+                            email, ([], []))
+                        occurrences.append(event)
+                        email_attendees.extend(email2attendees.get(email, []))
+                continue
+            icals = event2icals.get(event.id, {})
+            for type, from_addr, to_addrs, attendees in messages:
+                status = event.schedule_msg(type, owner, to_addrs,
+                    from_addr=from_addr, icals=icals,
+                    preferences=preferences)
+                if attendees:
+                    to_write.setdefault((type == 'new', status),
+                        []).extend(attendees)
+
+        for (parent, owner, type, from_addr), recipients in series.items():
+            # One message per set of occurrences
+            groups = OrderedDict()
+            for email, (occurrences, attendees) in recipients.items():
+                group = groups.setdefault(tuple(o.id for o in occurrences),
+                    (occurrences, [], []))
+                group[1].append(email)
+                group[2].extend(attendees)
+            icals = {}
+            for occurrences, to_addrs, attendees in groups.values():
+                status = parent.schedule_msg(type, owner, to_addrs,
+                    from_addr=from_addr, icals=icals, preferences=preferences,
+                    occurrences=occurrences)
+                if attendees:
+                    to_write.setdefault((type == 'new', status),
+                        []).extend(attendees)
+
+        for (new, status), attendees in to_write.items():
+            Attendee.store_schedule_status(attendees, status,
+                status=new and 'needs-action' or None)
 
-        for event in sum(args[::2], []):
-            current_attendees, owner = event.attendees_to_notify()
-            owner_email = owner and owner.email
-            current_emails = [a.email for a in current_attendees]
-            former_emails = event2former_emails.get(event.id, [])
-            missing_mails = filter(lambda mail: mail not in current_emails,
-                    former_emails)
-
-            if missing_mails:
-                with Transaction().set_context(skip_schedule_agent=True):
-                    ical = event.event2ical()
-                ical.add('method')
-                ical.method.value = 'CANCEL'
-
-                subject, body = event.subject_body('cancel', owner)
-                msg = cls.create_msg(former_organiser_mail[event.id],
-                    missing_mails, subject, body, ical)
-                sent = event.send_msg(former_organiser_mail[event.id],
-                    missing_mails, msg, 'cancel')
-
-            new_attendees = filter(lambda a: a.email not in former_emails,
-                current_attendees)
-            old_attendees = filter(lambda a: a.email in former_emails,
-                current_attendees)
-            with Transaction().set_context(skip_schedule_agent=True):
-                ical = event.event2ical()
-            if not hasattr(ical, 'method'):
-                ical.add('method')
-
-            sent_succes = []
-            sent_fail = []
-            if event in events_edited:
-                if event.status == 'cancelled':
-                    ical.method.value = 'CANCEL'
-                    # send cancel to old attendee
-                    subject, body = event.subject_body('cancel', owner)
-                    msg = cls.create_msg(owner_email,
-                        [a.email for a in old_attendees],
-                        subject, body, ical)
-                    sent = event.send_msg(owner_email,
-                        [a.email for a in old_attendees],
-                        msg, 'cancel')
-                    if sent:
-                        sent_succes += old_attendees
-                    else:
-                        sent_fail += old_attendees
-
-                else:
-                    ical.method.value = 'REQUEST'
-                    # send update to old attendees
-                    subject, body = event.subject_body('update', owner)
-                    msg = cls.create_msg(owner_email,
-                        [a.email for a in old_attendees],
-                        subject, body, ical)
-                    sent = event.send_msg(owner_email,
-                        [a.email for a in old_attendees],
-                        msg, 'update')
-                    if sent:
-                        sent_succes += old_attendees
-                    else:
-                        sent_fail += old_attendees
-                    # send new to new attendees
-                    subject, body = event.subject_body('new', owner)
-                    msg = cls.create_msg(owner_email,
-                        [a.email for a in new_attendees],
-                        subject, body, ical)
-                    sent = event.send_msg(owner_email,
-                        [a.email for a in new_attendees],
-                        msg, 'new')
-                    if sent:
-                        sent_succes += new_attendees
-                    else:
-                        sent_fail += new_attendees
+    @classmethod
+    def store_scheduling_fingerprints(cls, fingerprints):
+        '''
+        Store the scheduling fingerprints of the event ids
 
-            else:
-                if event.status != 'cancelled':
-                    ical.method.value = 'REQUEST'
-                    # send new to new attendees
-                    subject, body = event.subject_body('new', owner)
-                    msg = cls.create_msg(owner_email,
-                        [a.email for a in new_attendees],
-                        subject, body, ical)
-                    sent = event.send_msg(owner_email,
-                        [a.email for a in new_attendees],
-                        msg, 'new')
-                    if sent:
-                        sent_succes += new_attendees
-                    else:
-                        sent_fail += new_attendees
+        The column is updated directly to not increase the sequence of the
+        events.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        fingerprint2ids = {}
+        for id_, fingerprint in fingerprints.items():
+            fingerprint2ids.setdefault(fingerprint, []).append(id_)
+        for fingerprint, ids in fingerprint2ids.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        columns=[table.scheduling_fingerprint],
+                        values=[fingerprint],
+                        where=reduce_ids(table.id, sub_ids)))
 
-                vals = {'status': 'needs-action'}
-                vals['schedule_status'] = '1.1'  # successfully sent
-                if sent_succes:
-                    Attendee.write(sent_succes, vals)
-                vals['schedule_status'] = '5.1'  # could not complete delivery
-                if sent_fail:
-                    Attendee.write(sent_fail, vals)
+    @classmethod
+    def write_organizer_schedule_status(cls, event2status):
+        '''
+        Store the organizer schedule status of the events with one write
+        without notifying the attendees
+        '''
+        status2events = {}
+        for event, status in event2status.items():
+            status2events.setdefault(status, []).append(event)
+        args = []
+        for status, events in status2events.items():
+            args.extend((events, {'organizer_schedule_status': status}))
+        if args:
+            with Transaction().set_user(0):
+                cls.write(*args)
 
     @classmethod
     def delete(cls, events):
+        pool = Pool()
+        Outbox = pool.get('calendar.scheduling.outbox')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
+
+        # The deleted occurrences do not override their series anymore
+        series = [e.parent.id for e in events if e.parent]
         if Transaction().user == 0:
             # user is 0 means the deletion is triggered by another one
             super(Event, cls).delete(events)
+            BusyPeriod.index_remaining(series)
             return
 
         send_list = []
+        spool = None
+        if not Outbox.enabled() and Spool.enabled(len(events)):
+            # Stream the messages to disk instead of keeping them until the
+            # commit
+            spool = Spool()
+            spool_preferences = cls.notification_preferences(a.email
+                for e in events for a in e.attendees)
         for event in events:
             if event.status == 'cancelled':
                 continue
@@ -460,22 +878,50 @@ class Event:
             if not to_notify:
                 continue
 
-            with Transaction().set_context(skip_schedule_agent=True):
-                ical = event.event2ical()
-            ical.add('method')
-            ical.method.value = 'CANCEL'
-
+            ical = event.scheduling_ical('CANCEL')
             attendee_emails = [a.email for a in to_notify]
-            subject, body = event.subject_body('cancel', owner)
-            msg = cls.create_msg(owner.email, attendee_emails, subject, body,
-                ical)
+            metrics.inc('calendar_scheduling_messages_total', type='cancel')
+            metrics.inc('calendar_scheduling_recipients_total',
+                len(attendee_emails), type='cancel')
+            for language, emails in event.recipient_languages(
+                    attendee_emails, owner):
+                subject, body = event.subject_body('cancel', owner,
+                    language=language)
+                if Outbox.enabled():
+                    # The event will not exist anymore when the outbox is
+                    # processed
+                    Outbox.enqueue('cancel', 'CANCEL', owner.email, emails,
+                        event=event, owner=owner, subject=subject, body=body,
+                        ical=ical)
+                    continue
+                msg = cls.create_msg(owner.email, emails, subject, body, ical)
+                if spool is not None:
+                    to_addrs = cls.notified_addrs(emails, 'cancel',
+                        preferences=spool_preferences)
+                    if to_addrs:
+                        spool.put(owner.email, to_addrs, msg)
+                        status = '1.1'  # successfully sent
+                    else:
+                        status = '5.1'  # could not complete delivery
+                    metrics.inc('calendar_scheduling_status_total',
+                        status=status)
+                    continue
 
-            send_list.append((owner.email, attendee_emails, msg, event))
+                send_list.append((owner.email, emails, msg, event))
 
         super(Event, cls).delete(events)
+        BusyPeriod.index_remaining(series)
+        preferences = cls.notification_preferences(email
+            for _, attendee_emails, _, _ in send_list
+            for email in attendee_emails)
         for args in send_list:
             owner_email, attendee_emails, msg, event = args
-            event.send_msg(owner_email, attendee_emails, msg, 'cancel')
+            if event.send_msg(owner_email, attendee_emails, msg, 'cancel',
+                    preferences=preferences):
+                status = '1.1'  # successfully sent
+            else:
+                status = '5.1'  # could not complete delivery
+            metrics.inc('calendar_scheduling_status_total', status=status)
 
 
 class AttendeeMixin:
@@ -555,6 +1001,8 @@ class AttendeeMixin:
 class EventAttendee(AttendeeMixin, object):
     __metaclass__ = PoolMeta
     __name__ = 'calendar.event.attendee'
+    _subject_body_cache = Cache('calendar_event_attendee.subject_body',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -571,91 +1019,101 @@ class EventAttendee(AttendeeMixin, object):
                 'when': 'When',
                 })
 
-    def subject_body(self, status, owner):
+    @classmethod
+    def subject_body_template(cls, status, language):
+        '''
+        Return a dictionary with the translated strings needed to render the
+        reply with status in language
+        '''
         pool = Pool()
         Lang = pool.get('ir.lang')
         Event = pool.get('calendar.event')
+
+        key = (status, language)
+        template = cls._subject_body_cache.get(key)
+        if template is not None:
+            return template
+
+        langs = Lang.search([
+                ('code', '=', language),
+                ], limit=1)
+        fields_names = ['summary', 'dtstart', 'location', 'attendees']
+        with Transaction().set_context(language=language):
+            status_string = status
+            for k, v in cls.fields_get(
+                    fields_names=['status'])['status']['selection']:
+                if k == status:
+                    status_string = v
+
+            if status + '_body' in cls._error_messages:
+                body = cls.raise_user_error(status + '_body',
+                    raise_exception=False)
+                status_string = None
+            else:
+                body = cls.raise_user_error('body', raise_exception=False)
+
+            fields = Event.fields_get(fields_names=fields_names)
+            fields['dtstart']['string'] = cls.raise_user_error('when',
+                    raise_exception=False)
+            template = {
+                'subject': cls.raise_user_error('subject',
+                    raise_exception=False),
+                'body': body,
+                'status': status_string,
+                'no_subject': cls.raise_user_error('no_subject',
+                    raise_exception=False),
+                'separator': cls.raise_user_error('separator',
+                    raise_exception=False),
+                'bullet': cls.raise_user_error('bullet',
+                    raise_exception=False),
+                'fields': [(f, fields[f]['string']) for f in fields_names],
+                }
+        if langs:
+            lang, = langs
+            template['date'] = lang.date
+            template['direction'] = lang.direction
+        else:
+            template['date'] = '%m/%d/%Y'
+            template['direction'] = 'ltr'
+        cls._subject_body_cache.set(key, template)
+        return template
+
+    @metrics.timed('subject_body')
+    def subject_body(self, status, owner):
         event = self.event
 
         if not (event and owner):
             return "", ""
-        lang = owner.language
-        if not lang:
-            lang, = Lang.search([
-                    ('code', '=', 'en'),
-                    ], limit=1)
+        language = owner.language and owner.language.code or 'en'
+        template = self.subject_body_template(status, language)
+        separator = template['separator']
+        bullet = template['bullet']
 
         summary = event.summary
         if not summary:
-            with Transaction().set_context(language=lang.code):
-                summary = self.raise_user_error('no_subject',
-                        raise_exception=False)
-
-        if event.timezone:
-            tzevent = dateutil.tz.gettz(event.timezone)
-        else:
-            tzevent = tzlocal
-        dtstart = event.dtstart.replace(tzinfo=tzlocal).astimezone(tzevent)
-        if event.dtend:
-            dtend = event.dtend.replace(tzinfo=tzlocal).astimezone(tzevent)
-        else:
-            dtend = None
-
-        date = Lang.strftime(dtstart, lang.code, lang.date)
-        if not event.all_day:
-            date += ' ' + Lang.strftime(dtstart, lang.code, '%H:%M')
-            if event.dtend:
-                date += ' -'
-                if event.dtstart.date() != event.dtend.date():
-                    date += ' ' + Lang.strftime(dtend, lang.code,
-                        lang.date)
-                date += ' ' + Lang.strftime(dtend, lang.code, '%H:%M')
-        else:
-            if event.dtend and event.dtstart.date() != event.dtend.date():
-                date += ' - ' + Lang.strftime(dtend, lang.code,
-                    lang.date)
-        if event.timezone:
-            date += ' ' + event.timezone
-
-        status_string = status
-        fields_names = ['status']
-        with Transaction().set_context(language=lang.code):
-            fields = self.fields_get(fields_names=fields_names)
-        for k, v in fields['status']['selection']:
-            if k == status:
-                status_string = v
-
-        with Transaction().set_context(language=lang.code):
-            subject = self.raise_user_error('subject', (status, summary, date),
-                    raise_exception=False)
+            summary = template['no_subject']
 
-            if status + '_body' in self._error_messages:
-                body = self.raise_user_error(status + '_body',
-                        (owner.name, owner.email), raise_exception=False)
-            else:
-                body = self.raise_user_error('body',
-                        (owner.name, owner.email, status_string),
-                        raise_exception=False)
+        date = format_date_range(event.dtstart, event.dtend, event.all_day,
+            event.timezone, language, template['date'])
 
-            separator = self.raise_user_error('separator',
-                    raise_exception=False)
-            bullet = self.raise_user_error('bullet', raise_exception=False)
+        subject = format_template(template['subject'],
+            (status, summary, date))
+        body_args = (owner.name, owner.email)
+        if template['status'] is not None:
+            body_args += (template['status'],)
+        body = format_template(template['body'], body_args)
 
-            fields_names = ['summary', 'dtstart', 'location', 'attendees']
-            fields = Event.fields_get(fields_names=fields_names)
-            fields['dtstart']['string'] = self.raise_user_error('when',
-                    raise_exception=False)
-        for field in fields_names:
+        for field, string in template['fields']:
             if field == 'attendees':
                 organizer = event.organizer or event.parent.organizer
-                if lang.direction == 'ltr':
-                    body += fields['attendees']['string'] + separator + '\n'
+                if template['direction'] == 'ltr':
+                    body += string + separator + '\n'
                     if organizer:
                         body += bullet + organizer + '\n'
                     for attendee in event.attendees:
                         body += bullet + attendee.email + '\n'
                 else:
-                    body += separator + fields['attendees']['string'] + '\n'
+                    body += separator + string + '\n'
                     if organizer:
                         body += owner.email + bullet + '\n'
                     for attendee in event.attendees:
@@ -668,13 +1126,11 @@ class EventAttendee(AttendeeMixin, object):
                 elif field == 'location':
                     value = event.location.name
                 else:
-                    value = event[field]
-                if lang.direction == 'ltr':
-                    body += fields[field]['string'] + separator + ' ' \
-                        + value + '\n'
+                    value = getattr(event, field)
+                if template['direction'] == 'ltr':
+                    body += string + separator + ' ' + value + '\n'
                 else:
-                    body += value + ' ' + separator \
-                        + fields[field]['string'] + '\n'
+                    body += value + ' ' + separator + string + '\n'
         return subject, body
 
     @staticmethod
@@ -683,32 +1139,9 @@ class EventAttendee(AttendeeMixin, object):
         if not to_addr:
             return None
 
-        msg = MIMEMultipart()
-        msg['To'] = to_addr
-        msg['From'] = from_addr
-        msg['Subject'] = subject
-
-        inner = MIMEMultipart('alternative')
-
-        msg_body = MIMEBase('text', 'plain')
-        msg_body.set_payload(body.encode('UTF-8'), 'UTF-8')
-        inner.attach(msg_body)
-
-        attachment = MIMEBase('text', 'calendar',
-            method=ical.method.value)
-        attachment.set_payload(ical.serialize(), 'UTF-8')
-        inner.attach(attachment)
-
-        msg.attach(inner)
-        attachment = MIMEBase('application', 'ics')
-        attachment.set_payload(ical.serialize(), 'UTF-8')
-        attachment.add_header('Content-Disposition', 'attachment',
-                filename='invite.ics', name='invite.ics')
-
-        msg.attach(attachment)
-
-        return msg
+        return build_msg(from_addr, to_addr, subject, body, ical)
 
+    @metrics.timed('send_msg')
     def send_msg(self, from_addr, to_addr, msg):
         '''
         Send message and return True if the mail has been sent
@@ -716,6 +1149,79 @@ class EventAttendee(AttendeeMixin, object):
         sendmail_transactional(from_addr, to_addr, msg)
         return True
 
+    @metrics.timed('event2ical')
+    def reply_ical(self):
+        '''
+        Return the iCalendar of the REPLY message for the attendee
+
+        Only the properties required by RFC 5546 are set, so the other
+        attendees of the event are not read.
+        '''
+        event = self.event
+        ical = vobject.iCalendar()
+        ical.add('method').value = 'REPLY'
+        vevent = ical.add('vevent')
+        vevent.add('uid').value = event.uuid
+        vevent.add('sequence').value = str(event.sequence or 0)
+        vevent.add('dtstamp').value = datetime.datetime.now(tzutc)
+        organizer = event.organizer or event.parent and event.parent.organizer
+        if organizer:
+            vevent.add('organizer').value = 'MAILTO:' + organizer
+        if event.recurrence:
+            vevent.add('recurrence-id')
+            if event.all_day:
+                vevent.recurrence_id.value = event.recurrence.date()
+            else:
+                vevent.recurrence_id.value = event.recurrence.replace(
+                    tzinfo=tzlocal).astimezone(tzutc)
+        with Transaction().set_context(skip_schedule_agent=True):
+            vevent.attendee_list = [self.attendee2attendee()]
+        return ical
+
+    def schedule_msg(self, status, owner, organizer):
+        '''
+        Send or queue the reply with status to organizer and return the
+        schedule status of the organizer
+        '''
+        Outbox = Pool().get('calendar.scheduling.outbox')
+
+        metrics.inc('calendar_scheduling_messages_total', type='reply')
+        metrics.inc('calendar_scheduling_recipients_total', type='reply')
+        if Outbox.enabled():
+            Outbox.enqueue('reply', 'REPLY', owner.email, [organizer],
+                event=self.event, owner=owner, attendee=self, partstat=status)
+            schedule_status = '1.0'  # pending
+        else:
+            ical = self.reply_ical()
+            subject, body = self.subject_body(status, owner)
+            msg = self.create_msg(owner.email, organizer, subject, body, ical)
+            if self.send_msg(owner.email, organizer, msg):
+                schedule_status = '1.1'  # successfully sent
+            else:
+                schedule_status = '5.1'  # could not complete delivery
+        metrics.inc('calendar_scheduling_status_total',
+            status=schedule_status)
+        return schedule_status
+
+    @staticmethod
+    def partstat_owners(attendees):
+        '''
+        Return a dictionary mapping the attendees to the owner of their
+        calendar when the owner has the notification of replies enabled
+        '''
+        User = Pool().get('res.user')
+
+        owners = dict((a, a.event.calendar.owner) for a in attendees
+            if a.event.calendar.owner)
+        index = User.calendar_notification_index(
+            o.email for o in owners.values())
+        result = {}
+        for attendee, owner in owners.items():
+            entry = index.get(normalize_email(owner.email))
+            if entry is not None and entry[2]['partstat']:
+                result[attendee] = owner
+        return result
+
     def organiser_to_notify(self):
         event = self.event
         organizer = event.organizer or event.parent and event.parent.organizer
@@ -724,20 +1230,66 @@ class EventAttendee(AttendeeMixin, object):
         if event.organizer_schedule_agent \
                 and event.organizer_schedule_agent != 'SERVER':
             return None
-        if organizer == event.calendar.owner.email:
+        owner_email = normalize_email(event.calendar.owner.email)
+        if normalize_email(organizer) == owner_email:
             return None
-        if self.email != event.calendar.owner.email:
+        if normalize_email(self.email) != owner_email:
             return None
 
         return organizer
 
+    @classmethod
+    def store_schedule_status(cls, attendees, schedule_status, status=None):
+        '''
+        Store the schedule status and the status if set on the attendees
+        which do not have them yet
+
+        The columns are updated directly to not increase the sequence of the
+        events nor notify the change.
+        '''
+        BusyPeriod = Pool().get('calendar.scheduling.busy')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        attendees = [a for a in attendees
+            if a.schedule_status != schedule_status
+            or (status is not None and a.status != status)]
+        if not attendees:
+            return
+        busy_events = []
+        if status is not None:
+            busy_events = [a.event for a in attendees
+                if BusyPeriod.attendee_fbtype(a.status)
+                != BusyPeriod.attendee_fbtype(status)]
+        columns = [table.schedule_status]
+        values = [schedule_status]
+        if status is not None:
+            columns.append(table.status)
+            values.append(status)
+        for sub_attendees in grouped_slice(attendees):
+            cursor.execute(*table.update(columns=columns, values=values,
+                    where=reduce_ids(table.id, [a.id for a in sub_attendees])))
+
+        # Clean the caches like ModelStorage.write
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                for attendee in attendees:
+                    cache[cls.__name__].pop(attendee.id, None)
+        BusyPeriod.index_events(busy_events)
+
     @classmethod
     def write(cls, *args):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
 
+        busy_events = BusyPeriod.written_attendee_events(args)
         if Transaction().user == 0:
             # user is 0 means write is triggered by another one
             super(EventAttendee, cls).write(*args)
+            BusyPeriod.index_events(busy_events)
             return
 
         actions = iter(args)
@@ -750,10 +1302,16 @@ class EventAttendee(AttendeeMixin, object):
                     att2status[attendee.id] = attendee.status
 
         super(EventAttendee, cls).write(*args)
+        BusyPeriod.index_events(busy_events)
 
+        event2status = {}
+        # An attendee may be in many actions
+        status_attendees = cls.browse(list(OrderedDict.fromkeys(
+                    a.id for a in status_attendees)))
+        owners = cls.partstat_owners(status_attendees)
         for attendee in status_attendees:
-            owner = attendee.event.calendar.owner
-            if not owner or not owner.calendar_email_notification_partstat:
+            owner = owners.get(attendee)
+            if not owner:
                 continue
             organizer = attendee.organiser_to_notify()
             if not organizer:
@@ -765,98 +1323,110 @@ class EventAttendee(AttendeeMixin, object):
             if old == new:
                 continue
 
-            with Transaction().set_context(skip_schedule_agent=True):
-                ical = attendee.event.event2ical()
-                # Only the current attendee is needed
-                ical.vevent.attendee_list = [attendee.attendee2attendee()]
-            if not hasattr(ical, 'method'):
-                ical.add('method')
-            ical.method.value = 'REPLY'
-
-            subject, body = attendee.subject_body(new, owner)
-            msg = cls.create_msg(owner.email, organizer, subject, body, ical)
-
-            sent = attendee.send_msg(owner.email, organizer, msg)
+            event2status[attendee.event] = attendee.schedule_msg(new, owner,
+                organizer)
 
-            vals = {'organizer_schedule_status': sent and '1.1' or '5.1'}
-            Event.write([attendee.event], vals)
+        Event.write_organizer_schedule_status(event2status)
 
     @classmethod
     def delete(cls, attendees):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Outbox = pool.get('calendar.scheduling.outbox')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
 
+        busy_events = [e.id
+            for e in BusyPeriod.deleted_attendee_events(attendees)]
         if Transaction().user == 0:
             # user is 0 means the deletion is triggered by another one
             super(EventAttendee, cls).delete(attendees)
+            BusyPeriod.index_remaining(busy_events)
             return
 
         send_list = []
+        spool = None
+        if not Outbox.enabled() and Spool.enabled(len(attendees)):
+            # Stream the messages to disk instead of keeping them until the
+            # commit
+            spool = Spool()
+        owners = cls.partstat_owners(attendees)
         for attendee in attendees:
-            owner = attendee.event.calendar.owner
+            owner = owners.get(attendee)
 
             if attendee.status == 'declined':
                 continue
-            if not owner or not owner.calendar_email_notification_partstat:
+            if not owner:
                 continue
             organizer = attendee.organiser_to_notify()
             if not organizer:
                 continue
 
-            with Transaction().set_context(skip_schedule_agent=True):
-                ical = attendee.event.event2ical()
-                # Only the current attendee is needed
-                ical.vevent.attendee_list = [attendee.attendee2attendee()]
-            if not hasattr(ical, 'method'):
-                ical.add('method')
-            ical.method.value = 'REPLY'
-
+            ical = attendee.reply_ical()
             subject, body = attendee.subject_body('declined', owner)
+            if Outbox.enabled():
+                # The attendee will not exist anymore when the outbox is
+                # processed
+                Outbox.enqueue('reply', 'REPLY', owner.email, [organizer],
+                    event=attendee.event, owner=owner, partstat='declined',
+                    subject=subject, body=body, ical=ical)
+                send_list.append((None, None, None, attendee))
+                continue
             msg = cls.create_msg(owner.email, organizer, subject, body, ical)
+            if spool is not None:
+                spool.put(owner.email, [organizer], msg)
+                msg = spool
 
             send_list.append((owner.email, organizer, msg, attendee))
 
         super(EventAttendee, cls).delete(attendees)
+        BusyPeriod.index_remaining(busy_events)
+        event2status = {}
         for args in send_list:
             owner_email, organizer, msg, attendee = args
-            sent = attendee.send_msg(owner_email, organizer, msg)
-            vals = {'organizer_schedule_status': sent and '1.1' or '5.1'}
-            Event.write([attendee.event], vals)
+            if msg is None:
+                status = '1.0'  # pending
+            elif msg is spool or attendee.send_msg(owner_email, organizer,
+                    msg):
+                status = '1.1'  # successfully sent
+            else:
+                status = '5.1'  # could not complete delivery
+            metrics.inc('calendar_scheduling_messages_total', type='reply')
+            metrics.inc('calendar_scheduling_recipients_total', type='reply')
+            metrics.inc('calendar_scheduling_status_total', status=status)
+            event2status[attendee.event] = status
+        Event.write_organizer_schedule_status(event2status)
 
     @classmethod
     def create(cls, vlist):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
 
-        attendees = super(EventAttendee, cls).create(vlist)
+        index = not Transaction().context.get('skip_busy_index')
+        with Transaction().set_context(skip_busy_index=False):
+            attendees = super(EventAttendee, cls).create(vlist)
+        if index:
+            BusyPeriod.index_events([a.event for a in attendees])
         if Transaction().user == 0:
             # user is 0 means create is triggered by another one
             return attendees
 
+        event2status = {}
+        owners = cls.partstat_owners(attendees)
         for attendee in attendees:
-            owner = attendee.event.calendar.owner
+            owner = owners.get(attendee)
 
             if ((not attendee.status)
                     or attendee.status in ('', 'needs-action')):
                 continue
-            if not owner or not owner.calendar_email_notification_partstat:
+            if not owner:
                 continue
             organizer = attendee.organiser_to_notify()
             if not organizer:
                 continue
 
-            with Transaction().set_context(skip_schedule_agent=True):
-                ical = attendee.event.event2ical()
-                # Only the current attendee is needed
-                ical.vevent.attendee_list = [attendee.attendee2attendee()]
-            if not hasattr(ical, 'method'):
-                ical.add('method')
-            ical.method.value = 'REPLY'
-
-            subject, body = attendee.subject_body(attendee.status, owner)
-            msg = cls.create_msg(owner.email, organizer, subject, body, ical)
-
-            sent = attendee.send_msg(owner.email, organizer, msg)
-
-            vals = {'organizer_schedule_status': sent and '1.1' or '5.1'}
-            Event.write([attendee.event], vals)
+            event2status[attendee.event] = attendee.schedule_msg(
+                attendee.status, owner, organizer)
 
+        Event.write_organizer_schedule_status(event2status)
         return attendees
@@ -0,0 +1,210 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Delivery of scheduling messages sharded by recipient domain
+
+The messages to a domain are sent within the rate and concurrency limits of
+the domain and the domains are interleaved to keep the throughput.
+'''
+from collections import deque, OrderedDict
+from email.message import Message
+import logging
+import smtplib
+import socket
+import threading
+import time
+
+from trytond.config import config
+from trytond.sendmail import get_smtp_server
+
+from .metrics import metrics
+
+__all__ = ['domain', 'render', 'DomainScheduler', 'deliver']
+
+logger = logging.getLogger(__name__)
+
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+render_lock = threading.Lock()
+
+
+def domain(email):
+    "Return the domain of the email"
+    return email.rpartition('@')[2].strip().lower()
+
+
+def render(msg, to_addrs):
+    "Return the string of the MIME message sent to to_addrs"
+    # The message is shared by the jobs of the threads
+    with render_lock:
+        msg.replace_header('To', ', '.join(to_addrs))
+        return msg.as_string()
+
+
+class DomainScheduler(object):
+    '''
+    Interleave the jobs of the domains within their rate and concurrency
+
+    The limits are calendar_scheduling/domain_rate (messages per second, 0
+    for unlimited) and domain_concurrency which can be overridden per
+    domain with <domain>.rate and <domain>.concurrency in the section
+    calendar_scheduling_domain.
+
+    The limits are shared by the processes sending in parallel, but each
+    process keeps at least one connection per domain.
+    '''
+
+    def __init__(self, processes=1):
+        self.queues = OrderedDict()
+        self.next_times = {}
+        self.running = {}
+        self.condition = threading.Condition()
+        self.processes = max(1, processes)
+
+    def rate(self, domain):
+        return config.getfloat('calendar_scheduling_domain', domain + '.rate',
+            default=config.getfloat('calendar_scheduling', 'domain_rate',
+                default=0)) / self.processes
+
+    def concurrency(self, domain):
+        return max(1, config.getint('calendar_scheduling_domain',
+                domain + '.concurrency',
+                default=config.getint('calendar_scheduling',
+                    'domain_concurrency', default=1)) // self.processes)
+
+    def put(self, domain, job):
+        self.queues.setdefault(domain, deque()).append(job)
+
+    def next(self):
+        '''
+        Return the next (domain, job) waiting for the limits or None if
+        there is no more job
+        '''
+        with self.condition:
+            while self.queues:
+                now = time.time()
+                wait = None
+                for domain in list(self.queues):
+                    if self.running.get(domain, 0) >= self.concurrency(
+                            domain):
+                        continue
+                    next_time = self.next_times.get(domain, 0)
+                    if next_time > now:
+                        wait = min(wait or next_time - now, next_time - now)
+                        continue
+                    queue = self.queues.pop(domain)
+                    job = queue.popleft()
+                    if queue:
+                        # put the domain at the end to interleave them
+                        self.queues[domain] = queue
+                    self.running[domain] = self.running.get(domain, 0) + 1
+                    rate = self.rate(domain)
+                    if rate:
+                        self.next_times[domain] = now + 1. / rate
+                    return domain, job
+                self.condition.wait(wait)
+            return None
+
+    def done(self, domain):
+        with self.condition:
+            self.running[domain] -= 1
+            self.condition.notify_all()
+
+    def run(self, func, threads=1):
+        'Call func with each job from threads'
+        errors = []
+
+        def target():
+            while not errors:
+                item = self.next()
+                if item is None:
+                    break
+                domain, job = item
+                try:
+                    func(job)
+                except Exception as exception:
+                    errors.append(exception)
+                finally:
+                    self.done(domain)
+
+        if threads <= 1:
+            target()
+        else:
+            workers = [threading.Thread(target=target)
+                for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0]
+
+
+def deliver(jobs, server=None, processes=1):
+    '''
+    Send the (from_addr, to_addrs, data) jobs sharded by the domain of the
+    recipients and return the refused recipients per job
+
+    The jobs are sent by calendar_scheduling/delivery_threads threads with
+    their own SMTP connection unless server is given. When a connection is
+    lost, its job and the next ones of the thread are refused. processes is
+    the number of processes sharing the limits of the domains.
+
+    data may be a MIME message which is rendered with to_addrs as
+    recipients only when it is sent, and the jobs are released once sent so
+    the copies of the messages are not all kept in memory.
+    '''
+    scheduler = DomainScheduler(processes=processes)
+    for i, (_, to_addrs, _) in enumerate(jobs):
+        scheduler.put(domain(to_addrs[0]), i)
+    results = [None] * len(jobs)
+    local = threading.local()
+    connections = []
+    threads = 1
+    if server is None:
+        threads = config.getint('calendar_scheduling', 'delivery_threads',
+            default=1)
+
+    def connect():
+        local.server = get_smtp_server()
+        connections.append(local.server)
+        return local.server
+
+    @metrics.timed('send_msg')
+    def send(i):
+        from_addr, to_addrs, data = jobs[i]
+        jobs[i] = None
+        if getattr(local, 'broken', False):
+            # The jobs of a broken connection are retried by the next run
+            results[i] = dict.fromkeys(to_addrs)
+            return
+        if isinstance(data, Message):
+            data = render(data, to_addrs)
+        try:
+            connection = (server or getattr(local, 'server', None)
+                or connect())
+            try:
+                refused = connection.sendmail(from_addr, to_addrs, data)
+            except smtplib.SMTPServerDisconnected:
+                if server is not None:
+                    raise
+                refused = connect().sendmail(from_addr, to_addrs, data)
+        except smtplib.SMTPRecipientsRefused as exception:
+            refused = exception.recipients
+        except (smtplib.SMTPException, socket.error) as exception:
+            logger.error('fail to send scheduling message to %s',
+                ', '.join(to_addrs), exc_info=True)
+            if (isinstance(exception, CONNECTION_ERRORS)
+                    or not isinstance(exception, smtplib.SMTPException)):
+                local.broken = True
+            refused = dict.fromkeys(to_addrs)
+        results[i] = refused or {}
+
+    try:
+        scheduler.run(send, threads=threads)
+    finally:
+        for connection in connections:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+    return results
@@ -0,0 +1,408 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from collections import OrderedDict
+import datetime
+
+import dateutil.tz
+import vobject
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .res import normalize_email
+
+__all__ = ['BusyPeriod']
+tzlocal = dateutil.tz.tzlocal()
+tzutc = dateutil.tz.tzutc()
+
+# The fields of the events changing their busy periods
+EVENT_FIELDS = {'calendar', 'dtstart', 'dtend', 'all_day', 'timezone',
+    'status', 'transp', 'organizer', 'attendees', 'parent', 'recurrence',
+    'occurences', 'rrules', 'exrules', 'rdates', 'exdates'}
+# The fields of the occurrences changing the busy periods of their series
+OCCURRENCE_FIELDS = {'parent', 'recurrence'}
+
+
+def to_local(value):
+    "Return the naive local datetime of the iCalendar date or datetime"
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time())
+    if value.tzinfo:
+        value = value.astimezone(tzlocal).replace(tzinfo=None)
+    return value
+
+
+class BusyPeriod(ModelSQL):
+    'Calendar Scheduling Busy Period'
+    __name__ = 'calendar.scheduling.busy'
+    owner = fields.Many2One('res.user', 'Owner', required=True,
+        ondelete='CASCADE', select=True)
+    event = fields.Many2One('calendar.event', 'Event', required=True,
+        ondelete='CASCADE', select=True)
+    start = fields.DateTime('Start', required=True)
+    end = fields.DateTime('End', required=True)
+    fbtype = fields.Selection([
+            ('BUSY', 'Busy'),
+            ('BUSY-TENTATIVE', 'Busy Tentative'),
+            ], 'Free/Busy Type', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(BusyPeriod, cls).__setup__()
+        cls.__rpc__.update({
+                'freebusy': RPC(),
+                'freebusy_reply': RPC(),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(BusyPeriod, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['owner', 'start'], 'add')
+
+    @staticmethod
+    def horizon():
+        "Return the duration indexed around now"
+        return datetime.timedelta(days=config.getint(
+                'calendar_scheduling', 'freebusy_horizon', default=366))
+
+    @staticmethod
+    def attendee_fbtype(status, fbtype='BUSY'):
+        '''
+        Return the free/busy type of an attendee with status for an event of
+        fbtype or None if the attendee is free
+        '''
+        if status in ('declined', 'delegated'):
+            return None
+        if status != 'accepted':
+            return 'BUSY-TENTATIVE'
+        return fbtype
+
+    @classmethod
+    def event_fbtype(cls, event, owner):
+        '''
+        Return the free/busy type of the event for the owner of its
+        calendar or None if the owner is free
+        '''
+        if event.status == 'cancelled' or event.transp == 'transparent':
+            return None
+        fbtype = 'BUSY'
+        if event.status == 'tentative':
+            fbtype = 'BUSY-TENTATIVE'
+        owner_email = normalize_email(owner.email)
+        organizer = event.organizer or event.parent and event.parent.organizer
+        if normalize_email(organizer) == owner_email:
+            return fbtype
+        attendees = event.attendees
+        if not attendees and event.parent:
+            attendees = event.parent.attendees
+        for attendee in attendees:
+            if normalize_email(attendee.email) != owner_email:
+                continue
+            return cls.attendee_fbtype(attendee.status, fbtype)
+        return fbtype
+
+    @staticmethod
+    def event_periods(event, start, end):
+        '''
+        Return the list of (start, end) of the event between start and end
+        with the recurrences expanded and whether there are recurrences
+        after end
+        '''
+        duration = (event.dtend or event.dtstart) - event.dtstart
+        if event.all_day and not duration:
+            duration = datetime.timedelta(days=1)
+        if not (event.rrules or event.rdates):
+            return [(event.dtstart, event.dtstart + duration)], False
+
+        vevent = event.event2ical().vevent
+        rruleset = vevent.getrruleset(addRDate=True)
+        dtstart = vevent.dtstart.value
+        if (isinstance(dtstart, datetime.datetime)
+                and dtstart.tzinfo is not None):
+            start = start.replace(tzinfo=tzlocal)
+            end = end.replace(tzinfo=tzlocal)
+        # The modified occurrences are indexed on their own
+        overridden = set(o.recurrence for o in event.occurences)
+        periods = []
+        for value in rruleset.between(start - duration, end, inc=True):
+            value = to_local(value)
+            if value in overridden:
+                continue
+            periods.append((value, value + duration))
+        return periods, rruleset.after(end) is not None
+
+    @classmethod
+    def written_events(cls, args):
+        '''
+        Return the events of the write arguments whose busy periods may have
+        changed
+        '''
+        events = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if not EVENT_FIELDS.intersection(values):
+                continue
+            events.extend(records)
+            if OCCURRENCE_FIELDS.intersection(values):
+                # The occurrences override the periods of their series
+                events.extend(e.parent for e in records if e.parent)
+        return events
+
+    @classmethod
+    def written_attendee_events(cls, args):
+        '''
+        Return the events whose busy periods may be changed by the write
+        arguments of their attendees
+
+        It must be called before the write.
+        '''
+        Event = Pool().get('calendar.event')
+        events = []
+        actions = iter(args)
+        for attendees, values in zip(actions, actions):
+            if values.get('event'):
+                events.append(Event(values['event']))
+            for attendee in attendees:
+                if ('event' in values
+                        or ('status' in values
+                            and cls.attendee_fbtype(attendee.status)
+                            != cls.attendee_fbtype(values['status']))):
+                    events.append(attendee.event)
+        return events
+
+    @classmethod
+    def deleted_attendee_events(cls, attendees):
+        '''
+        Return the events whose busy periods may be changed by the deletion
+        of the attendees
+        '''
+        events = []
+        for attendee in attendees:
+            event = attendee.event
+            owner = event.calendar.owner
+            # An occurrence without attendees uses those of its series
+            if (event.parent
+                    or (owner and normalize_email(attendee.email)
+                        == normalize_email(owner.email))):
+                events.append(event)
+        return events
+
+    @classmethod
+    def index_remaining(cls, ids):
+        "Update the busy periods of the events of ids which still exist"
+        Event = Pool().get('calendar.event')
+        if not ids:
+            return
+        with Transaction().set_context(_check_access=False):
+            cls.index_events(Event.search([
+                        ('id', 'in', list(set(ids))),
+                        ]))
+
+    @classmethod
+    def index_events(cls, events):
+        '''
+        Update the busy periods of the events
+
+        The recurrences are expanded until the end of the horizon which is
+        stored on the series to be extended by expand_series.
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = Event.__table__()
+
+        horizon = cls.horizon()
+        now = datetime.datetime.now()
+        start, end = now - horizon, now + horizon
+
+        ids = list(OrderedDict.fromkeys(
+                e.id for e in events if e.id is not None))
+        # The index is maintained for the user whatever its access
+        updated = []
+        with Transaction().set_context(_check_access=False):
+            events = Event.browse(ids)
+            for sub_events in grouped_slice(events):
+                sub_events = list(sub_events)
+                cls.delete(cls.search([
+                            ('event', 'in', [e.id for e in sub_events]),
+                            ]))
+                vlist = []
+                expanded = []
+                for event in sub_events:
+                    owner = event.calendar.owner
+                    if not owner or not owner.email:
+                        continue
+                    fbtype = cls.event_fbtype(event, owner)
+                    if not fbtype:
+                        continue
+                    periods, more = cls.event_periods(event, start, end)
+                    if more:
+                        expanded.append(event.id)
+                    for period_start, period_end in periods:
+                        vlist.append({
+                                'owner': owner.id,
+                                'event': event.id,
+                                'start': period_start,
+                                'end': period_end,
+                                'fbtype': fbtype,
+                                })
+                if vlist:
+                    cls.create(vlist)
+                # The column is updated directly to not increase the sequence
+                # of the events
+                completed = [e.id for e in sub_events
+                    if e.busy_until and e.id not in expanded]
+                for until, until_ids in [(None, completed), (end, expanded)]:
+                    if until_ids:
+                        cursor.execute(*table.update(
+                                columns=[table.busy_until],
+                                values=[until],
+                                where=reduce_ids(table.id, until_ids)))
+                        updated.extend(until_ids)
+
+        if updated:
+            # Clean the caches like ModelStorage.write
+            transaction.counter += 1
+            for cache in transaction.cache.values():
+                if Event.__name__ in cache:
+                    for id_ in updated:
+                        cache[Event.__name__].pop(id_, None)
+
+    @classmethod
+    def expand_series(cls):
+        '''
+        Index again the series whose recurrences are expanded until less
+        than calendar_scheduling/freebusy_margin days before the end of the
+        horizon
+        '''
+        Event = Pool().get('calendar.event')
+        margin = datetime.timedelta(days=config.getint(
+                'calendar_scheduling', 'freebusy_margin', default=30))
+        limit = datetime.datetime.now() + cls.horizon() - margin
+        with Transaction().set_context(active_test=False):
+            events = Event.search([
+                    ('busy_until', '!=', None),
+                    ('busy_until', '<', limit),
+                    ])
+        cls.index_events(events)
+
+    @classmethod
+    def readable_owners(cls, owners):
+        '''
+        Return the set of owners whose busy periods the user can read
+
+        The periods are readable like the calendars of the owners.
+        '''
+        Calendar = Pool().get('calendar.calendar')
+        transaction = Transaction()
+
+        if (transaction.user == 0
+                or not transaction.context.get('_check_access')):
+            return set(owners)
+        readable = set()
+        for sub_owners in grouped_slice(owners):
+            # The search applies the record rules of the calendars
+            readable.update(c.owner.id for c in Calendar.search([
+                        ('owner', 'in', list(sub_owners)),
+                        ]))
+        return readable
+
+    @classmethod
+    def freebusy(cls, emails, start, end):
+        '''
+        Return a dictionary mapping the emails of the users to the sorted
+        list of (start, end, fbtype) busy periods between start and end
+
+        The overlapping periods of the same type are merged. When called
+        from RPC, only the users owning a calendar readable by the user are
+        returned.
+        '''
+        User = Pool().get('res.user')
+
+        index = User.calendar_notification_index(emails)
+        owner2email = {}
+        for email in emails:
+            entry = index.get(normalize_email(email))
+            if entry:
+                owner2email[entry[0]] = email
+        readable = cls.readable_owners(list(owner2email))
+        owner2email = dict((o, e) for o, e in owner2email.items()
+            if o in readable)
+        result = dict((e, []) for e in owner2email.values())
+        last = {}
+        for sub_owners in grouped_slice(list(owner2email)):
+            with Transaction().set_context(_check_access=False):
+                periods = cls.search_read([
+                        ('owner', 'in', list(sub_owners)),
+                        ('start', '<', end),
+                        ('end', '>', start),
+                        ], order=[('owner', 'ASC'), ('start', 'ASC')],
+                    fields_names=['owner', 'start', 'end', 'fbtype'])
+            for period in periods:
+                email = owner2email[period['owner']]
+                busy = result[email]
+                fbtype = period['fbtype']
+                period_start = max(period['start'], start)
+                period_end = min(period['end'], end)
+                i = last.get((email, fbtype))
+                if i is not None and busy[i][1] >= period_start:
+                    busy[i] = (busy[i][0], max(busy[i][1], period_end),
+                        fbtype)
+                else:
+                    last[email, fbtype] = len(busy)
+                    busy.append((period_start, period_end, fbtype))
+        return result
+
+    @classmethod
+    def freebusy_reply(cls, data):
+        '''
+        Return the list of (email, request status, iCalendar) answering the
+        VFREEBUSY request in data for each attendee
+
+        The iCalendar is None if the attendee is not a user or if the user can
+        not read its calendar.
+        '''
+        request = vobject.readOne(data)
+        vfreebusy = request.vfreebusy
+        start = to_local(vfreebusy.dtstart.value)
+        end = to_local(vfreebusy.dtend.value)
+        emails = [a.value[len('mailto:'):] if a.value.lower().startswith(
+                    'mailto:') else a.value
+            for a in vfreebusy.contents.get('attendee', [])]
+        busy = cls.freebusy(emails, start, end)
+
+        def utc(value):
+            return value.replace(tzinfo=tzlocal).astimezone(tzutc)
+
+        replies = []
+        for email in emails:
+            if email not in busy:
+                replies.append((email, '3.7', None))  # invalid user
+                continue
+            ical = vobject.iCalendar()
+            ical.add('method').value = 'REPLY'
+            reply = ical.add('vfreebusy')
+            if hasattr(vfreebusy, 'uid'):
+                reply.add('uid').value = vfreebusy.uid.value
+            if hasattr(vfreebusy, 'organizer'):
+                reply.add('organizer').value = vfreebusy.organizer.value
+            reply.add('attendee').value = 'mailto:' + email
+            reply.add('dtstamp').value = datetime.datetime.now(tzutc)
+            reply.add('dtstart').value = utc(start)
+            reply.add('dtend').value = utc(end)
+            for period_start, period_end, fbtype in busy[email]:
+                freebusy = reply.add('freebusy')
+                freebusy.value = [(utc(period_start), utc(period_end))]
+                freebusy.fbtype_param = fbtype
+            replies.append((email, '2.0', ical.serialize()))  # success
+        return replies
@@ -0,0 +1,255 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Ingest the iMIP replies of a maildir or a mbox
+
+The partstat of the replies is applied on the attendees of the events of
+the organizer:
+
+    python -m trytond.modules.calendar_scheduling.imip -d DATABASE PATH
+'''
+from argparse import ArgumentParser
+from collections import OrderedDict
+from itertools import islice
+import email.parser
+import logging
+import mailbox
+import os
+
+import vobject
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from .freebusy import to_local
+from .metrics import metrics
+from .res import normalize_email
+
+__all__ = ['read_replies', 'ingest']
+
+logger = logging.getLogger(__name__)
+
+FeedParser = getattr(email.parser, 'BytesFeedParser', email.parser.FeedParser)
+PARTSTATS = ['needs-action', 'accepted', 'declined', 'tentative', 'delegated']
+
+
+def parse_file(file_):
+    "Parse the message of file_ by chunks"
+    parser = FeedParser()
+    for chunk in iter(lambda: file_.read(8192), b''):
+        parser.feed(chunk)
+    return parser.close()
+
+
+def read_messages(path):
+    "Yield the messages of the maildir or mbox at path"
+    if os.path.isdir(path):
+        box = mailbox.Maildir(path, factory=None, create=False)
+    else:
+        box = mailbox.mbox(path, factory=None, create=False)
+    try:
+        for key in box.iterkeys():
+            file_ = box.get_file(key)
+            try:
+                yield parse_file(file_)
+            finally:
+                file_.close()
+    finally:
+        box.close()
+
+
+def read_replies(path):
+    '''
+    Yield the (method, uid, recurrence, organizer, attendee, partstat,
+    dtstamp) of the REPLY and COUNTER in the messages at path
+    '''
+    for msg in read_messages(path):
+        for part in msg.walk():
+            if part.get_content_type() not in (
+                    'text/calendar', 'application/ics'):
+                continue
+            data = part.get_payload(decode=True)
+            try:
+                ical = vobject.readOne(data.decode(
+                        part.get_content_charset() or 'utf-8'))
+            except Exception:
+                logger.warning('fail to parse iCalendar of %s',
+                    msg.get('Message-ID'), exc_info=True)
+                continue
+            method = hasattr(ical, 'method') and ical.method.value.upper()
+            if method not in ('REPLY', 'COUNTER'):
+                continue
+            for vevent in ical.contents.get('vevent', []):
+                if not hasattr(vevent, 'uid') or not hasattr(
+                        vevent, 'organizer'):
+                    continue
+                recurrence = None
+                if hasattr(vevent, 'recurrence_id'):
+                    recurrence = to_local(vevent.recurrence_id.value)
+                dtstamp = None
+                if hasattr(vevent, 'dtstamp'):
+                    dtstamp = to_local(vevent.dtstamp.value)
+                for attendee in vevent.contents.get('attendee', []):
+                    partstat = attendee.params.get('PARTSTAT',
+                        ['needs-action'])[0].lower()
+                    yield (method, vevent.uid.value, recurrence,
+                        mailto(vevent.organizer.value), mailto(attendee.value),
+                        partstat, dtstamp)
+            # the other parts are the same iCalendar
+            break
+
+
+def mailto(value):
+    "Return the normalized email of the calendar user address"
+    if value.lower().startswith('mailto:'):
+        value = value[len('mailto:'):]
+    return normalize_email(value)
+
+
+def create_occurrences(key2master):
+    '''
+    Create the occurrences of the series masters which are not stored yet
+    and return them by (uid, recurrence, organizer)
+
+    The occurrence is a copy of the series like the one created by a CalDAV
+    client which changes only that occurrence.
+    '''
+    Event = Pool().get('calendar.event')
+
+    key2occurrence = {}
+    with Transaction().set_user(0):
+        for (uid, recurrence, organizer), master in key2master.items():
+            duration = None
+            if master.dtend:
+                duration = master.dtend - master.dtstart
+            occurrence, = Event.copy([master], default={
+                    'uuid': master.uuid,
+                    'parent': master.id,
+                    'recurrence': recurrence,
+                    'dtstart': recurrence,
+                    'dtend': duration and recurrence + duration,
+                    'rdates': [],
+                    'rrules': [],
+                    'exdates': [],
+                    'exrules': [],
+                    'occurences': [],
+                    'vevent': None,
+                    'busy_until': None,
+                    })
+            key2occurrence[(uid, recurrence, organizer)] = occurrence
+    return key2occurrence
+
+
+def apply_replies(replies):
+    '''
+    Apply the partstat of the replies on the attendees of the organizer
+    events and return the number of updated attendees
+
+    The latest reply of an attendee wins. A COUNTER only marks the
+    attendee as having received the request.
+    '''
+    pool = Pool()
+    Event = pool.get('calendar.event')
+    Attendee = pool.get('calendar.event.attendee')
+
+    latest = OrderedDict()
+    for reply in replies:
+        method, uid, recurrence, organizer, attendee, partstat, dtstamp = \
+            reply
+        key = (uid, recurrence, organizer, attendee)
+        if (key not in latest or latest[key][-1] is None
+                or (dtstamp and dtstamp >= latest[key][-1])):
+            latest[key] = reply
+        metrics.inc('calendar_scheduling_replies_total', method=method)
+
+    events = []
+    for sub_uids in grouped_slice(
+            list(OrderedDict.fromkeys(k[0] for k in latest))):
+        events.extend(Event.search([
+                    ('uuid', 'in', list(sub_uids)),
+                    ]))
+    key2event = {}
+    for event in events:
+        owner = event.calendar.owner
+        if not owner:
+            continue
+        key2event[(event.uuid, event.recurrence,
+                normalize_email(owner.email))] = event
+
+    # A reply for an occurrence which was never changed
+    key2master = OrderedDict()
+    for uid, recurrence, organizer, _ in latest:
+        key = (uid, recurrence, organizer)
+        master = key2event.get((uid, None, organizer))
+        if (recurrence and key not in key2event and master
+                and (master.rrules or master.rdates)):
+            key2master[key] = master
+    key2event.update(create_occurrences(key2master))
+
+    to_write = {}
+    for (uid, recurrence, organizer, email), reply in latest.items():
+        event = key2event.get((uid, recurrence, organizer))
+        if not event:
+            logger.info('no event %s %s of %s for reply of %s',
+                uid, recurrence, organizer, email)
+            continue
+        method, partstat = reply[0], reply[5]
+        for attendee in event.attendees:
+            if normalize_email(attendee.email) != email:
+                continue
+            status = attendee.status
+            if method == 'REPLY' and partstat in PARTSTATS:
+                status = partstat
+            to_write.setdefault(status, []).append(attendee)
+
+    args = []
+    for status, attendees in to_write.items():
+        args.extend((attendees, {
+                    'status': status,
+                    'schedule_status': '1.2',  # delivered
+                    }))
+    if args:
+        # The replies must not be notified again
+        with Transaction().set_user(0):
+            Attendee.write(*args)
+    return sum(len(a) for a in to_write.values())
+
+
+def ingest(path):
+    '''
+    Apply the replies of the maildir or mbox at path by batches of
+    calendar_scheduling/batch_size and return the number of updated
+    attendees
+    '''
+    size = config.getint('calendar_scheduling', 'batch_size', default=1000)
+    replies = read_replies(path)
+    count = 0
+    while True:
+        batch = list(islice(replies, size))
+        if not batch:
+            break
+        count += apply_replies(batch)
+    return count
+
+
+def main(database, path):
+    Pool.start()
+    Pool(database).init()
+    with Transaction().start(database, 0) as transaction:
+        count = ingest(path)
+        transaction.commit()
+    print('%d attendees updated' % count)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config',
+        help='specify config file')
+    parser.add_argument('-d', '--database', dest='database', required=True,
+        help='database name')
+    parser.add_argument('path', help='maildir or mbox of the replies')
+    options = parser.parse_args()
+    config.update_etc(options.config)
+    main(options.database, options.path)
@@ -0,0 +1,43 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Translation', 'Lang']
+__metaclass__ = PoolMeta
+
+
+class SubjectBodyCacheMixin:
+    'Clear the cached templates of the scheduling messages on change'
+
+    @staticmethod
+    def _clear_subject_body_cache():
+        pool = Pool()
+        for name in ['calendar.event', 'calendar.event.attendee']:
+            pool.get(name)._subject_body_cache.clear()
+        pool.get('calendar.event')._render_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(SubjectBodyCacheMixin, cls).create(vlist)
+        cls._clear_subject_body_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(SubjectBodyCacheMixin, cls).write(*args)
+        cls._clear_subject_body_cache()
+
+    @classmethod
+    def delete(cls, records):
+        super(SubjectBodyCacheMixin, cls).delete(records)
+        cls._clear_subject_body_cache()
+
+
+class Translation(SubjectBodyCacheMixin, object):
+    __metaclass__ = PoolMeta
+    __name__ = 'ir.translation'
+
+
+class Lang(SubjectBodyCacheMixin, object):
+    __metaclass__ = PoolMeta
+    __name__ = 'ir.lang'
@@ -0,0 +1,158 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Counters and histograms of the scheduling pipeline
+
+The values are kept per process and can be exported in the Prometheus text
+format. If metrics_file is configured, each process writes it at most every
+metrics_interval seconds after an instrumented call.
+'''
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+import os
+import tempfile
+import time
+
+from trytond.config import config
+
+__all__ = ['metrics']
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class Metrics(object):
+    'Registry of counters and histograms'
+
+    def __init__(self):
+        self._lock = Lock()
+        self._dumped = None
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(BUCKETS),
+                    'sum': 0.,
+                    'count': 0,
+                    }
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, phase):
+        'Observe the duration of the block as phase'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe('calendar_scheduling_phase_seconds',
+                time.time() - start, phase=phase)
+            self.autodump()
+
+    def timed(self, phase):
+        'Decorate a function to observe its duration as phase'
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        '''
+        Return a dictionary with the counters as (name, labels, value) and
+        the histograms as (name, labels, {'buckets', 'sum', 'count'})
+        '''
+        with self._lock:
+            counters = [(n, dict(l), v)
+                for (n, l), v in sorted(self._counters.items())]
+            histograms = [(n, dict(l), {
+                        'buckets': list(zip(BUCKETS, h['buckets'])),
+                        'sum': h['sum'],
+                        'count': h['count'],
+                        })
+                for (n, l), h in sorted(self._histograms.items())]
+        return {
+            'counters': counters,
+            'histograms': histograms,
+            }
+
+    def prometheus(self):
+        'Return the metrics in the Prometheus text format'
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, v)
+                for k, v in sorted(labels.items()))
+
+        snapshot = self.snapshot()
+        lines = []
+        types = set()
+        for name, labels, value in snapshot['counters']:
+            if name not in types:
+                lines.append('# TYPE %s counter' % name)
+                types.add(name)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for name, labels, histogram in snapshot['histograms']:
+            if name not in types:
+                lines.append('# TYPE %s histogram' % name)
+                types.add(name)
+            for bound, count in histogram['buckets']:
+                bucket_labels = dict(labels, le=repr(float(bound)))
+                lines.append('%s_bucket%s %s' % (
+                        name, format_labels(bucket_labels), count))
+            lines.append('%s_bucket%s %s' % (name,
+                    format_labels(dict(labels, le='+Inf')),
+                    histogram['count']))
+            lines.append('%s_sum%s %s' % (
+                    name, format_labels(labels), histogram['sum']))
+            lines.append('%s_count%s %s' % (
+                    name, format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        'Write atomically the Prometheus text format into path'
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.calendar_')
+        with os.fdopen(fd, 'w') as file_:
+            file_.write(self.prometheus())
+        os.rename(tmp, path)
+
+    def autodump(self, force=False):
+        '''
+        Dump into the configured metrics_file if the previous dump of the
+        process is older than metrics_interval seconds or if force
+        '''
+        path = config.get('calendar_scheduling', 'metrics_file')
+        if not path:
+            return
+        interval = config.getint('calendar_scheduling', 'metrics_interval',
+            default=60)
+        now = time.time()
+        with self._lock:
+            if (not force and self._dumped is not None
+                    and now - self._dumped < interval):
+                return
+            self._dumped = now
+        self.dump(path)
+
+
+metrics = Metrics()
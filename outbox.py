@@ -0,0 +1,442 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from collections import OrderedDict
+import datetime
+import logging
+
+import vobject
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.rpc import RPC
+
+from .delivery import deliver, domain
+from .metrics import metrics
+
+__all__ = ['Outbox']
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(ModelSQL, ModelView):
+    'Calendar Scheduling Outbox'
+    __name__ = 'calendar.scheduling.outbox'
+    event = fields.Many2One('calendar.event', 'Event', ondelete='SET NULL',
+        select=True)
+    attendee = fields.Many2One('calendar.event.attendee', 'Attendee',
+        ondelete='SET NULL')
+    owner = fields.Many2One('res.user', 'Owner', ondelete='SET NULL')
+    type = fields.Selection([
+            ('new', 'New'),
+            ('update', 'Update'),
+            ('cancel', 'Cancel'),
+            ('reply', 'Reply'),
+            ], 'Type', required=True, readonly=True)
+    method = fields.Selection([
+            ('REQUEST', 'Request'),
+            ('CANCEL', 'Cancel'),
+            ('REPLY', 'Reply'),
+            ], 'Method', required=True, readonly=True)
+    partstat = fields.Char('Participation Status', readonly=True)
+    from_addr = fields.Char('From', required=True, readonly=True)
+    to_addrs = fields.Text('To', required=True, readonly=True)
+    subject = fields.Text('Subject', readonly=True)
+    body = fields.Text('Body', readonly=True)
+    ical = fields.Text('iCalendar', readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('sent', 'Sent'),
+            ('failed', 'Failed'),
+            ('deferred', 'Deferred'),
+            ], 'State', required=True, readonly=True, select=True)
+    send_after = fields.DateTime('Send After', readonly=True, select=True)
+    attempts = fields.Integer('Attempts', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Outbox, cls).__setup__()
+        cls._order.insert(0, ('id', 'ASC'))
+        cls.__rpc__.update({
+                'get_metrics': RPC(),
+                'replay_deferred': RPC(readonly=False),
+                })
+        cls._error_messages.update({
+                'admin_only': 'Only administrators can call "%s".',
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def enabled():
+        '''
+        Return True if scheduling messages must be queued instead of sent
+        inside the transaction that triggers them
+
+        The messages are always queued when the context has
+        defer_scheduling, they are then kept deferred until replay.
+        '''
+        if Transaction().context.get('defer_scheduling'):
+            return True
+        return config.getboolean('calendar_scheduling', 'outbox',
+            default=False)
+
+    @classmethod
+    def enqueue(cls, type, method, from_addr, to_addrs, event=None,
+            owner=None, attendee=None, partstat=None, subject=None,
+            body=None, ical=None, merge=True):
+        '''
+        Queue a scheduling message and return it or None if it is coalesced
+        with the pending messages of the event
+
+        The message is rendered by the worker unless subject, body and ical
+        are given, which is needed when the event or the attendee will not
+        exist anymore at sending time. If merge is False, the message is not
+        coalesced. The access of the user to the outbox is not checked.
+        '''
+        with Transaction().set_context(_check_access=False):
+            state = 'pending'
+            if Transaction().context.get('defer_scheduling'):
+                state = 'deferred'
+            to_addrs = list(to_addrs)
+            if merge and event is not None:
+                to_addrs = cls.coalesce(type, from_addr, to_addrs, event,
+                    state=state)
+                if not to_addrs:
+                    return None
+
+            if ical is not None:
+                ical = ical.serialize()
+            delay = config.getint('calendar_scheduling', 'coalesce_delay',
+                default=0)
+            send_after = None
+            if delay:
+                send_after = (datetime.datetime.now()
+                    + datetime.timedelta(seconds=delay))
+            message, = cls.create([{
+                        'type': type,
+                        'method': method,
+                        'from_addr': from_addr,
+                        'to_addrs': '\n'.join(to_addrs),
+                        'event': event and event.id,
+                        'owner': owner and owner.id,
+                        'attendee': attendee and attendee.id,
+                        'partstat': partstat,
+                        'subject': subject,
+                        'body': body,
+                        'ical': ical,
+                        'send_after': send_after,
+                        'state': state,
+                        }])
+        return message
+
+    @classmethod
+    def coalesce(cls, type, from_addr, to_addrs, event, state='pending'):
+        '''
+        Merge the message of type to to_addrs into the messages of the event
+        in state and return the recipients still needing a new message
+
+        The messages are rendered with the final state of the event when
+        sent, so an update is not needed for recipients of a pending
+        invitation or update, and a cancellation removes the recipients
+        from the pending invitations and updates and is not needed for the
+        recipients who never received the invitation. A reply replaces the
+        previous replies of the same attendee.
+        '''
+        if type == 'reply':
+            cls.delete(cls.search([
+                        ('event', '=', event.id),
+                        ('state', '=', state),
+                        ('type', '=', 'reply'),
+                        ('from_addr', '=', from_addr),
+                        ]))
+            return to_addrs
+
+        pending = cls.search([
+                ('event', '=', event.id),
+                ('state', '=', state),
+                ('type', 'in', ['new', 'update']),
+                ('ical', '=', None),
+                ])
+        to_delete = []
+        to_save = []
+        for message in pending:
+            recipients = message.to_addrs.splitlines()
+            if type == 'cancel':
+                kept = [e for e in recipients if e not in to_addrs]
+                if message.type == 'new':
+                    to_addrs = [e for e in to_addrs if e not in recipients]
+                if not kept:
+                    to_delete.append(message)
+                elif len(kept) != len(recipients):
+                    message.to_addrs = '\n'.join(kept)
+                    to_save.append(message)
+            elif type == 'update' and message.type == 'new':
+                to_addrs = [e for e in to_addrs if e not in recipients]
+            elif (type == message.type
+                    and from_addr == message.from_addr):
+                added = [e for e in to_addrs if e not in recipients]
+                if added:
+                    message.to_addrs = '\n'.join(recipients + added)
+                    to_save.append(message)
+                to_addrs = []
+        if to_delete:
+            cls.delete(to_delete)
+        if to_save:
+            cls.save(to_save)
+        return to_addrs
+
+    def get_msgs(self, recipients):
+        '''
+        Return the list of (emails, MIME message) to send to recipients or
+        an empty list if it can not be rendered anymore
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Attendee = pool.get('calendar.event.attendee')
+
+        if self.ical:
+            ical = vobject.readOne(self.ical)
+            subject, body = self.subject or '', self.body or ''
+        elif self.type == 'reply':
+            if not self.attendee:
+                return []
+            ical = self.attendee.reply_ical()
+            subject, body = self.attendee.subject_body(self.partstat,
+                self.owner)
+        else:
+            if not self.event:
+                return []
+            ical = self.event.scheduling_ical(self.method)
+            return self.event.scheduling_msgs(self.type, self.owner,
+                self.from_addr, recipients, ical)
+
+        if self.type == 'reply':
+            return [(recipients, Attendee.create_msg(self.from_addr,
+                        recipients[0], subject, body, ical))]
+        return [(recipients, Event.create_msg(self.from_addr, recipients,
+                    subject, body, ical))]
+
+    def deliveries(self, preferences=None):
+        '''
+        Return the schedule status per recipient, the notified recipients
+        and the list of (from_addr, to_addrs, msg) to send with one message
+        per recipient domain
+
+        The MIME messages are shared by the domains and rendered when sent.
+
+        The status defaults to 5.1 until the delivery succeeds.
+        '''
+        Event = Pool().get('calendar.event')
+
+        to_addrs = self.to_addrs.splitlines()
+        recipients = to_addrs
+        if self.type != 'reply':
+            recipients = Event.notified_addrs(to_addrs, self.type,
+                preferences=preferences)
+        # could not complete delivery
+        statuses = dict.fromkeys(to_addrs, '5.1')
+        msgs = self.get_msgs(recipients) if recipients else []
+
+        jobs = []
+        for emails, msg in msgs:
+            domains = OrderedDict()
+            for email in emails:
+                domains.setdefault(domain(email), []).append(email)
+            for domain_emails in domains.values():
+                jobs.append((self.from_addr, domain_emails, msg))
+        return statuses, recipients, jobs
+
+    @classmethod
+    def lock_pending(cls, messages):
+        '''
+        Return the messages which are still pending and lock them until the
+        end of the transaction
+
+        On PostgreSQL, the messages locked by another transaction are
+        skipped so the cron task and the workers do not send them twice.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        pending = set()
+        for sub_messages in grouped_slice(messages):
+            query = table.select(table.id,
+                where=reduce_ids(table.id, [m.id for m in sub_messages])
+                & (table.state == 'pending'))
+            if backend.name() == 'postgresql':
+                # python-sql does not support SKIP LOCKED
+                sql, params = tuple(query)
+                cursor.execute(sql + ' FOR UPDATE SKIP LOCKED', params)
+            else:
+                cursor.execute(*query)
+            pending.update(r[0] for r in cursor.fetchall())
+        return [m for m in messages if m.id in pending]
+
+    @classmethod
+    def process(cls, messages=None, server=None, processes=1):
+        '''
+        Send pending messages sharded by recipient domain and store the
+        schedule status on the attendees or on the event for replies
+
+        The failed deliveries are retried with an exponential backoff until
+        calendar_scheduling/retry_max attempts. processes is the number of
+        processes sending the outbox in parallel.
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Attendee = pool.get('calendar.event.attendee')
+
+        now = datetime.datetime.now()
+        if messages is None:
+            messages = cls.search([
+                    ('state', '=', 'pending'),
+                    ['OR',
+                        ('send_after', '=', None),
+                        ('send_after', '<=', now),
+                        ],
+                    ], limit=config.getint('calendar_scheduling',
+                    'batch_size', default=1000))
+        messages = cls.lock_pending(messages)
+        if not messages:
+            return
+
+        preferences = Event.notification_preferences(email
+            for message in messages if message.type != 'reply'
+            for email in message.to_addrs.splitlines())
+        retry_max = config.getint('calendar_scheduling', 'retry_max',
+            default=5)
+        retry_delay = config.getint('calendar_scheduling', 'retry_delay',
+            default=300)
+
+        jobs = []
+        deliveries = []
+        for message in messages:
+            statuses, recipients, message_jobs = message.deliveries(
+                preferences=preferences)
+            deliveries.append((message, statuses, recipients,
+                    range(len(jobs), len(jobs) + len(message_jobs))))
+            jobs.extend(message_jobs)
+        results = deliver(jobs, server=server, processes=processes)
+        del jobs
+
+        attendees = {}
+        event2status = {}
+        states = {}
+        to_retry = []
+        for message, statuses, recipients, indexes in deliveries:
+            refused = {}
+            for i in indexes:
+                refused.update(results[i])
+            if refused:
+                logger.warning('fail to send scheduling message %s to %s',
+                    message.id, ', '.join(refused))
+            if indexes and len(refused) < len(recipients):
+                for email in statuses:
+                    if email not in refused:
+                        statuses[email] = '1.1'  # successfully sent
+            failed = [e for e in recipients if e in refused]
+            sent = '1.1' in statuses.values()
+            retry = failed and message.attempts + 1 < retry_max
+            if retry:
+                to_retry.append((message, failed, sent))
+                for email in failed:
+                    statuses[email] = '1.0'  # pending
+            elif failed:
+                logger.error('give up scheduling message %s after %s '
+                    'attempts', message.id, message.attempts + 1)
+            metrics.inc('calendar_scheduling_status_total',
+                status=sent and '1.1' or retry and '1.0' or '5.1')
+            if sent or not retry:
+                states.setdefault(sent and 'sent' or 'failed',
+                    []).append(message)
+            if not message.event:
+                continue
+            if message.type == 'reply':
+                event2status[message.event], = statuses.values()
+                continue
+            for attendee in message.event.attendees:
+                if attendee.email in statuses:
+                    attendees.setdefault(statuses[attendee.email],
+                        []).append(attendee)
+
+        with Transaction().set_user(0):
+            for status, records in attendees.items():
+                Attendee.write(records, {'schedule_status': status})
+        Event.write_organizer_schedule_status(event2status)
+        for state, records in states.items():
+            cls.write(records, {'state': state})
+        for message, failed, sent in to_retry:
+            values = {
+                'to_addrs': '\n'.join(failed),
+                'attempts': message.attempts + 1,
+                'send_after': now + datetime.timedelta(
+                    seconds=retry_delay * 2 ** message.attempts),
+                }
+            if sent:
+                # Retry only the recipients who did not receive it
+                values['state'] = 'pending'
+                cls.copy([message], default=values)
+            else:
+                cls.write([message], values)
+
+        # Publish the statuses of the batch without waiting for the interval
+        metrics.autodump(force=True)
+
+    @classmethod
+    def check_admin(cls, name):
+        'Check the user calling name through RPC is an administrator'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        User = pool.get('res.user')
+
+        transaction = Transaction()
+        if (transaction.user == 0
+                or not transaction.context.get('_check_access')):
+            return
+        if ModelData.get_id('res', 'group_admin') not in User.get_groups():
+            cls.raise_user_error('admin_only', (name,))
+
+    @classmethod
+    def replay(cls, messages=None, server=None):
+        '''
+        Send the deferred messages
+
+        The messages have been coalesced when they were queued, so only the
+        net effect of the changes is sent.
+        '''
+        with Transaction().set_context(_check_access=False):
+            if messages is None:
+                messages = cls.search([
+                        ('state', '=', 'deferred'),
+                        ])
+            for sub_messages in grouped_slice(messages,
+                    config.getint('calendar_scheduling', 'batch_size',
+                        default=1000)):
+                sub_messages = list(sub_messages)
+                cls.write(sub_messages, {
+                        'state': 'pending',
+                        'send_after': None,
+                        })
+                cls.process(sub_messages, server=server)
+
+    @classmethod
+    def replay_deferred(cls):
+        'Send all the deferred messages from RPC'
+        cls.check_admin('replay_deferred')
+        cls.replay()
+
+    @classmethod
+    def get_metrics(cls):
+        'Return the scheduling metrics of the process'
+        cls.check_admin('get_metrics')
+        return metrics.snapshot()
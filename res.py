@@ -1,11 +1,24 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from sql import Null
+
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
 
 __all__ = ['User']
 __metaclass__ = PoolMeta
 
+NOTIFICATION_TYPES = ['new', 'update', 'cancel', 'partstat']
+
+
+def normalize_email(email):
+    "Return the email in the form used to compare addresses"
+    return (email or '').strip().lower()
+
 
 class User:
     __name__ = 'res.user'
@@ -17,6 +30,12 @@ class User:
             'Cancelled invitations')
     calendar_email_notification_partstat = fields.Boolean(
             'Invitation Replies')
+    calendar_email = fields.Char('Calendar Email', readonly=True,
+        select=True)
+    _calendar_notification_cache = Cache('res_user.calendar_notification',
+        size_limit=config.getint('calendar_scheduling', 'user_index_size',
+            default=10000),
+        context=False)
 
     @staticmethod
     def default_calendar_email_notification_new():
@@ -43,3 +62,95 @@ class User:
             'calendar_email_notification_cancel',
             'calendar_email_notification_partstat',
             ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        super(User, cls).__register__(module_name)
+
+        # Migration from 4.2: fill calendar_email
+        cursor.execute(*table.select(table.id, table.email,
+                where=(table.calendar_email == Null)
+                & (table.email != Null)))
+        for id_, email in cursor.fetchall():
+            cursor.execute(*table.update(
+                    columns=[table.calendar_email],
+                    values=[normalize_email(email)],
+                    where=table.id == id_))
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            values['calendar_email'] = normalize_email(
+                values.get('email')) or None
+        users = super(User, cls).create(vlist)
+        cls._calendar_notification_cache.clear()
+        return users
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for users, values in zip(actions, actions):
+            if 'email' in values:
+                values = values.copy()
+                values['calendar_email'] = normalize_email(
+                    values['email']) or None
+            args.extend((users, values))
+        super(User, cls).write(*args)
+        cls._calendar_notification_cache.clear()
+
+    @classmethod
+    def delete(cls, users):
+        super(User, cls).delete(users)
+        cls._calendar_notification_cache.clear()
+
+    @classmethod
+    def calendar_notification_index(cls, emails):
+        '''
+        Return a dictionary mapping the normalized emails to the tuple of
+        user id, language code and the notification flags by type, or None
+        if no user has the email
+
+        The entries are kept in a cache cleared when users are modified.
+        '''
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+
+        index = {}
+        missing = set()
+        for email in emails:
+            key = normalize_email(email)
+            if not key or key in index:
+                continue
+            entry = cls._calendar_notification_cache.get(key, -1)
+            if entry == -1:
+                missing.add(key)
+            else:
+                index[key] = entry
+        if not missing:
+            return index
+
+        users = []
+        for sub_emails in grouped_slice(list(missing)):
+            users.extend(cls.search_read([
+                        ('calendar_email', 'in', list(sub_emails)),
+                        ],
+                    fields_names=['calendar_email', 'language']
+                    + ['calendar_email_notification_' + t
+                        for t in NOTIFICATION_TYPES]))
+        codes = dict((l.id, l.code) for l in Lang.browse(list(
+                    set(u['language'] for u in users if u['language']))))
+        found = {}
+        for user in users:
+            found.setdefault(user['calendar_email'], (
+                    user['id'], codes.get(user['language']),
+                    dict((t, user['calendar_email_notification_' + t])
+                        for t in NOTIFICATION_TYPES)))
+        for key in missing:
+            index[key] = found.get(key)
+            cls._calendar_notification_cache.set(key, index[key])
+        return index
@@ -0,0 +1,87 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Disk spool of scheduling messages
+
+The messages are written as JSON lines into a temporary file and sent when
+the transaction is committed, so a large number of them does not stay in
+memory like with sendmail_transactional.
+'''
+import json
+import logging
+import tempfile
+
+from trytond.config import config
+from trytond.sendmail import get_smtp_server
+from trytond.transaction import Transaction
+
+__all__ = ['Spool']
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    'Temporary file of scheduling messages sent at the commit'
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile('w+',
+            dir=config.get('calendar_scheduling', 'spool_dir'),
+            prefix='calendar_')
+        self.size = 0
+        Transaction().join(self)
+
+    @staticmethod
+    def enabled(size):
+        '''
+        Return True if size messages must be spooled instead of kept in
+        memory until the commit
+        '''
+        threshold = config.getint('calendar_scheduling', 'spool_threshold',
+            default=100)
+        return bool(threshold) and size > threshold
+
+    def __len__(self):
+        return self.size
+
+    def put(self, from_addr, to_addrs, msg):
+        'Append the message to the spool'
+        self.file.write(json.dumps([from_addr, to_addrs, msg.as_string()]))
+        self.file.write('\n')
+        self.size += 1
+
+    def __iter__(self):
+        self.file.flush()
+        self.file.seek(0)
+        for line in self.file:
+            yield json.loads(line)
+
+    def abort(self, trans):
+        self._finish()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        if self.size:
+            server = get_smtp_server()
+            for from_addr, to_addrs, msg in self:
+                try:
+                    server.sendmail(from_addr, to_addrs, msg)
+                except Exception:
+                    logger.error('fail to send email', exc_info=True)
+            server.quit()
+        self._finish()
+
+    def tpc_abort(self, trans):
+        self._finish()
+
+    def _finish(self):
+        if not self.file.closed:
+            self.file.close()
+        self.size = 0
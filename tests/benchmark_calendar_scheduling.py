@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark the scheduling overhead of calendar events and attendees
+
+Run on SQLite with the sending of emails replaced by a counter:
+
+    python benchmark_calendar_scheduling.py --events 100 --attendees 10
+
+The database defaults to an in-memory SQLite. TRYTOND_DATABASE_URI and
+DB_NAME must be exported to run it with python -m because the tests package
+imports trytond.tests.test_tryton before this module:
+
+    TRYTOND_DATABASE_URI=sqlite:// DB_NAME=:memory: \
+        python -m trytond.modules.calendar_scheduling.tests.\
+benchmark_calendar_scheduling
+'''
+from argparse import ArgumentParser
+import datetime
+import os
+import time
+import uuid
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.calendar_scheduling import calendar_
+from trytond.modules.calendar_scheduling.spool import Spool
+from trytond.modules.calendar_scheduling.tests.test_calendar_scheduling \
+    import QueryCounter, create_events
+
+
+class MailCounter(object):
+    'Replace sendmail_transactional by counting messages and bytes'
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def __call__(self, from_addr, to_addrs, msg, *args, **kwargs):
+        self.messages += 1
+        self.bytes += len(msg.as_string())
+
+    def spool(self, spool, from_addr, to_addrs, msg):
+        'Count the message and write it to the spool'
+        self(from_addr, to_addrs, msg)
+        spool_put(spool, from_addr, to_addrs, msg)
+
+
+# The spooled messages are only sent at the commit which never happens
+spool_put = Spool.put
+
+
+def create_invitations(number):
+    'Create number events of an external organizer in the attendee calendar'
+    pool = Pool()
+    User = pool.get('res.user')
+    Calendar = pool.get('calendar.calendar')
+    Event = pool.get('calendar.event')
+
+    attendee, = User.create([{
+                'login': 'attendee',
+                'name': 'Attendee',
+                'email': 'attendee@example.com',
+                }])
+    calendar, = Calendar.create([{
+                'name': 'attendee',
+                'owner': attendee.id,
+                }])
+    with Transaction().set_user(0):
+        return Event.create([{
+                    'calendar': calendar.id,
+                    'uuid': str(uuid.uuid4()),
+                    'summary': 'Invitation %s' % i,
+                    'dtstart': datetime.datetime(2017, 1, 1, 9),
+                    'dtend': datetime.datetime(2017, 1, 1, 10),
+                    'organizer': 'organizer@external.example.com',
+                    'attendees': [('create', [{
+                                    'email': attendee.email,
+                                    'status': 'needs-action',
+                                    }])],
+                    } for i in range(number)])
+
+
+def measure(name, func, results):
+    'Run func and append its latency, queries and mails to results'
+    transaction = Transaction()
+    counter = MailCounter()
+    calendar_.sendmail_transactional = counter
+    Spool.put = lambda spool, *args: counter.spool(spool, *args)
+    transaction.cache.clear()
+    connection = transaction.connection
+    queries = transaction.connection = QueryCounter(connection)
+    start = time.time()
+    try:
+        value = func()
+    finally:
+        duration = time.time() - start
+        transaction.connection = connection
+    results.append((name, duration, queries.count, counter.messages,
+            counter.bytes))
+    return value
+
+
+def run(events_number, attendees_number):
+    pool = Pool()
+    Event = pool.get('calendar.event')
+    Attendee = pool.get('calendar.event.attendee')
+
+    results = []
+    events = measure('create', lambda: create_events(
+            events_number, attendees_number, notify=True), results)
+    measure('write fields', lambda: Event.write(events, {
+                'summary': 'Updated',
+                'dtstart': datetime.datetime(2017, 1, 2, 9),
+                }), results)
+    measure('add attendee', lambda: Event.write(events, {
+                'attendees': [('create', [{
+                                'email': 'new@example.com',
+                                }])],
+                }), results)
+    added = Attendee.search([('email', '=', 'new@example.com')])
+    measure('remove attendee', lambda: Event.write(*sum((
+                    ([a.event], {'attendees': [('delete', [a.id])]})
+                    for a in added), ())), results)
+    measure('cancel', lambda: Event.write(events, {
+                'status': 'cancelled',
+                }), results)
+    removed = create_events(events_number, attendees_number)
+    measure('delete', lambda: Event.delete(removed), results)
+
+    invitations = create_invitations(events_number)
+    replies = Attendee.search([
+            ('event', 'in', [e.id for e in invitations]),
+            ])
+    measure('partstat', lambda: Attendee.write(replies, {
+                'status': 'accepted',
+                }), results)
+    return results
+
+
+def main(events_number, attendees_number):
+    activate_module('calendar_scheduling')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        try:
+            results = run(events_number, attendees_number)
+        finally:
+            transaction.rollback()
+
+    print('%d events x %d attendees' % (events_number, attendees_number))
+    print('%-16s %10s %8s %8s %10s' % (
+            'operation', 'ms', 'queries', 'mails', 'bytes'))
+    for name, duration, queries, messages, size in results:
+        print('%-16s %10.1f %8d %8d %10d' % (
+                name, duration * 1000, queries, messages, size))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--events', dest='events', type=int, default=100,
+        help='number of events')
+    parser.add_argument('--attendees', dest='attendees', type=int,
+        default=10, help='number of attendees per event')
+    options = parser.parse_args()
+    main(options.events, options.attendees)
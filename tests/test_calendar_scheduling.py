@@ -1,14 +1,1027 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from contextlib import contextmanager
+from email.mime.text import MIMEText
+import datetime
+import errno
+import os
+import smtplib
+import socket
+import tempfile
 import unittest
+import uuid
+
+import vobject
+
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.calendar_scheduling import calendar_, delivery, spool
+from trytond.modules.calendar_scheduling.metrics import metrics
+
+
+class QueryCounter(object):
+    'Count the queries executed on the cursors of a connection'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self.connection.cursor(*args, **kwargs), self)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class CountingCursor(object):
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SMTPServer(object):
+    'Stand-in of smtplib.SMTP which refuses some recipients'
+
+    def __init__(self, refused=(), disconnected=False):
+        self.refused = set(refused)
+        self.disconnected = disconnected
+        self.messages = []
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected()
+        self.messages.append((from_addr, to_addrs, msg))
+        return dict((a, (550, 'User unknown'))
+            for a in to_addrs if a in self.refused)
+
+    def quit(self):
+        pass
+
+
+@contextmanager
+def record_sendmail():
+    'Replace the sending of the messages at the commit by a list'
+    messages = []
+
+    def sendmail(from_addr, to_addrs, msg, *args, **kwargs):
+        messages.append((from_addr, to_addrs, msg))
+    sendmail_transactional = calendar_.sendmail_transactional
+    calendar_.sendmail_transactional = sendmail
+    try:
+        yield messages
+    finally:
+        calendar_.sendmail_transactional = sendmail_transactional
+
+
+def create_events(number, attendees=3, notify=False):
+    '''
+    Create number events organized by the owner of their calendar
+
+    The attendees are notified only if notify is True.
+    '''
+    pool = Pool()
+    User = pool.get('res.user')
+    Calendar = pool.get('calendar.calendar')
+    Event = pool.get('calendar.event')
+
+    organizers = User.search([('login', '=', 'organizer')])
+    if organizers:
+        organizer, = organizers
+        calendar, = Calendar.search([('owner', '=', organizer.id)])
+    else:
+        organizer, = User.create([{
+                    'login': 'organizer',
+                    'name': 'Organizer',
+                    'email': 'organizer@example.com',
+                    }])
+        calendar, = Calendar.create([{
+                    'name': 'organizer',
+                    'owner': organizer.id,
+                    }])
+    with Transaction().set_user(Transaction().user if notify else 0):
+        return Event.create([{
+                    'calendar': calendar.id,
+                    'uuid': str(uuid.uuid4()),
+                    'summary': 'Event %s' % i,
+                    'dtstart': datetime.datetime(2017, 1, 1, 9),
+                    'dtend': datetime.datetime(2017, 1, 1, 10),
+                    'organizer': organizer.email,
+                    'attendees': [('create', [{
+                                    'email': 'attendee%s@example.com' % j,
+                                    } for j in range(attendees)])],
+                    } for i in range(number)])
+
+
+def reply_mbox(uid, recurrence=None):
+    '''
+    Return the path of a mbox with the acceptance of attendee0 to the event
+    uid or its occurrence at recurrence
+    '''
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Test//Test//EN',
+        'METHOD:REPLY',
+        'BEGIN:VEVENT',
+        'UID:%s' % uid,
+        'DTSTAMP:20170101T080000Z',
+        'ORGANIZER:mailto:organizer@example.com',
+        'ATTENDEE;PARTSTAT=ACCEPTED:mailto:Attendee0@example.com',
+        'END:VEVENT',
+        'END:VCALENDAR',
+        '']
+    if recurrence:
+        lines.insert(6, 'RECURRENCE-ID:%s' % recurrence)
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as mbox:
+        mbox.write('From attendee0@example.com Sun Jan  1 08:00:00 2017\n')
+        mbox.write('Content-Type: text/calendar; method=REPLY\n\n')
+        mbox.write('\n'.join(lines))
+        mbox.write('\n')
+    return path
 
 
 class CalendarSchedulingTestCase(ModuleTestCase):
     'Test CalendarScheduling module'
     module = 'calendar_scheduling'
 
+    def count_notify_queries(self, events):
+        'Return the queries executed to find the attendees to notify'
+        Event = Pool().get('calendar.event')
+        transaction = Transaction()
+
+        events = Event.browse([e.id for e in events])
+        # Warm the caches which do not depend on the events
+        events[0].attendees_to_notify()
+        transaction.cache.clear()
+        connection = transaction.connection
+        counter = transaction.connection = QueryCounter(connection)
+        try:
+            for event in Event.browse([e.id for e in events]):
+                event.attendees_to_notify()
+        finally:
+            transaction.connection = connection
+        return counter.count
+
+    @with_transaction()
+    def test_notify_queries(self):
+        'Test attendees to notify does not depend on the number of events'
+        small = self.count_notify_queries(create_events(5))
+        large = self.count_notify_queries(create_events(50))
+        self.assertEqual(small, large)
+
+    @with_transaction()
+    def test_outbox_process(self):
+        'Test outbox sends the queued message and stores the status'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Outbox = pool.get('calendar.scheduling.outbox')
+
+        event, = create_events(1)
+        emails = sorted(a.email for a in event.attendees)
+        message = Outbox.enqueue('new', 'REQUEST', 'organizer@example.com',
+            emails, event=event, owner=event.calendar.owner)
+        self.assertEqual(message.state, 'pending')
+        server = SMTPServer()
+        Outbox.process(server=server)
+
+        (from_addr, to_addrs, msg), = server.messages
+        self.assertEqual(from_addr, 'organizer@example.com')
+        self.assertEqual(sorted(to_addrs), emails)
+        self.assertIn('method="REQUEST"', msg)
+        self.assertEqual(Outbox(message.id).state, 'sent')
+        event = Event(event.id)
+        self.assertEqual(set(a.schedule_status for a in event.attendees),
+            {'1.1'})
+
+    @with_transaction()
+    def test_outbox_access(self):
+        'Test only administrators read and replay the outbox'
+        pool = Pool()
+        User = pool.get('res.user')
+        ModelAccess = pool.get('ir.model.access')
+        Outbox = pool.get('calendar.scheduling.outbox')
+
+        admin, = User.search([('login', '=', 'admin')])
+        user, = User.create([{
+                    'login': 'user',
+                    'name': 'User',
+                    }])
+        event, = create_events(1)
+        for user_id, read in [(admin.id, True), (user.id, False)]:
+            with Transaction().set_user(user_id), \
+                    Transaction().set_context(_check_access=True):
+                access = ModelAccess.get_access(
+                    ['calendar.scheduling.outbox'])
+                self.assertEqual(access['calendar.scheduling.outbox'], {
+                        'read': read,
+                        'write': False,
+                        'create': False,
+                        'delete': False,
+                        })
+                # The scheduling of the user is still queued
+                self.assertTrue(Outbox.enqueue('new', 'REQUEST',
+                        'organizer@example.com', ['attendee0@example.com'],
+                        event=event, merge=False))
+                if read:
+                    Outbox.replay_deferred()
+                    Outbox.get_metrics()
+                else:
+                    self.assertRaises(UserError, Outbox.replay_deferred)
+                    self.assertRaises(UserError, Outbox.get_metrics)
+
+    @with_transaction()
+    def test_outbox_coalesce(self):
+        'Test coalescing of cancel, new and update into pending messages'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Outbox = pool.get('calendar.scheduling.outbox')
+
+        event, = create_events(1)
+        owner = event.calendar.owner
+
+        def enqueue(type, to_addrs):
+            method = type == 'cancel' and 'CANCEL' or 'REQUEST'
+            return Outbox.enqueue(type, method, owner.email,
+                ['%s@example.com' % e for e in to_addrs], event=event,
+                owner=owner)
+
+        def recipients(message):
+            return [e.split('@')[0]
+                for e in Outbox(message.id).to_addrs.splitlines()]
+
+        new = enqueue('new', ['a', 'b'])
+        # The pending invitation is rendered with the update
+        self.assertIsNone(enqueue('update', ['a']))
+        self.assertIsNone(enqueue('new', ['c']))
+        self.assertEqual(recipients(new), ['a', 'b', 'c'])
+
+        # The cancellation is not needed if the invitation is not sent
+        self.assertIsNone(enqueue('cancel', ['b']))
+        self.assertEqual(recipients(new), ['a', 'c'])
+
+        update = enqueue('update', ['d'])
+        self.assertIsNone(enqueue('update', ['e']))
+        self.assertEqual(recipients(update), ['d', 'e'])
+
+        cancel = enqueue('cancel', ['a', 'c', 'd'])
+        self.assertEqual(recipients(cancel), ['d'])
+        self.assertEqual(Outbox.search([('id', '=', new.id)]), [])
+        self.assertEqual(recipients(update), ['e'])
+
+        # The attendees of an event cancelled before sending are not pending
+        with Transaction().set_context(defer_scheduling=True):
+            event, = create_events(1, notify=True)
+            self.assertEqual(set(a.schedule_status for a in event.attendees),
+                set(['1.0']))
+            Event.write([event], {
+                    'status': 'cancelled',
+                    })
+        self.assertEqual(Outbox.search([('event', '=', event.id)]), [])
+        self.assertEqual(
+            [a.schedule_status for a in Event(event.id).attendees],
+            [None] * 3)
+
+    @with_transaction()
+    def test_outbox_refused_recipients(self):
+        'Test outbox stores the status of each recipient and retries'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Outbox = pool.get('calendar.scheduling.outbox')
+
+        event, = create_events(1)
+        message = Outbox.enqueue('new', 'REQUEST', 'organizer@example.com',
+            [a.email for a in event.attendees], event=event,
+            owner=event.calendar.owner)
+        server = SMTPServer(refused=['attendee0@example.com'])
+        Outbox.process([message], server=server)
+
+        self.assertEqual(len(server.messages), 1)
+        self.assertEqual(Outbox(message.id).state, 'sent')
+        event = Event(event.id)
+        self.assertEqual(
+            dict((a.email, a.schedule_status) for a in event.attendees), {
+                'attendee0@example.com': '1.0',
+                'attendee1@example.com': '1.1',
+                'attendee2@example.com': '1.1',
+                })
+        retry, = Outbox.search([
+                ('state', '=', 'pending'),
+                ])
+        self.assertEqual(retry.to_addrs, 'attendee0@example.com')
+        self.assertEqual(retry.attempts, 1)
+        self.assertGreater(retry.send_after, datetime.datetime.now())
+
+    @with_transaction()
+    def test_outbox_lost_connection(self):
+        'Test outbox retries the messages of a lost connection'
+        Outbox = Pool().get('calendar.scheduling.outbox')
+
+        messages = []
+        for event in create_events(2):
+            messages.append(Outbox.enqueue('new', 'REQUEST',
+                    'organizer@example.com',
+                    [a.email for a in event.attendees], event=event,
+                    owner=event.calendar.owner))
+        Outbox.process(messages, server=SMTPServer(disconnected=True))
+
+        for message in Outbox.browse([m.id for m in messages]):
+            self.assertEqual(message.state, 'pending')
+            self.assertEqual(message.attempts, 1)
+            self.assertGreater(message.send_after, datetime.datetime.now())
+
+        def get_smtp_server():
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+        smtp_server = delivery.get_smtp_server
+        delivery.get_smtp_server = get_smtp_server
+        try:
+            Outbox.process(messages)
+        finally:
+            delivery.get_smtp_server = smtp_server
+
+        for message in Outbox.browse([m.id for m in messages]):
+            self.assertEqual(message.attempts, 2)
+
+    @with_transaction()
+    def test_outbox_domain_sharding(self):
+        'Test outbox sends one message per recipient domain'
+        Outbox = Pool().get('calendar.scheduling.outbox')
+
+        event, = create_events(1)
+        message = Outbox.enqueue('new', 'REQUEST', 'organizer@example.com',
+            ['attendee0@example.com', 'attendee1@example.com',
+                'guest@example.org'], event=event,
+            owner=event.calendar.owner)
+        server = SMTPServer()
+        Outbox.process([message], server=server)
+
+        self.assertEqual(sorted(sorted(to_addrs)
+                for _, to_addrs, _ in server.messages), [
+                ['attendee0@example.com', 'attendee1@example.com'],
+                ['guest@example.org'],
+                ])
+        for _, to_addrs, msg in server.messages:
+            self.assertIn('To: %s\n' % ', '.join(to_addrs), msg)
+
+    @with_transaction()
+    def test_outbox_render_lazily(self):
+        'Test outbox renders the copy of each domain only when sent'
+        Outbox = Pool().get('calendar.scheduling.outbox')
+
+        event, = create_events(1)
+        message = Outbox.enqueue('new', 'REQUEST', 'organizer@example.com',
+            ['attendee0@example.com', 'guest@example.org'], event=event,
+            owner=event.calendar.owner)
+        _, _, jobs = message.deliveries()
+        self.assertEqual(sorted(to_addrs for _, to_addrs, _ in jobs),
+            [['attendee0@example.com'], ['guest@example.org']])
+        self.assertIs(jobs[0][2], jobs[1][2])
+
+        server = SMTPServer()
+        results = delivery.deliver(jobs, server=server)
+        self.assertEqual(results, [{}, {}])
+        self.assertEqual(jobs, [None, None])
+        for _, to_addrs, msg in server.messages:
+            self.assertEqual('guest@example.org' in msg,
+                to_addrs == ['guest@example.org'])
+
+    def test_worker_partition(self):
+        'Test worker sends the messages of an event from the same process'
+        from trytond.modules.calendar_scheduling.worker import partition
+        messages = [{'id': i, 'event': i // 3 + 1} for i in range(1, 13)]
+        messages += [{'id': i, 'event': None} for i in range(13, 17)]
+
+        partitions = {}
+        for message in messages:
+            partitions.setdefault(partition(message, 4), []).append(message)
+        self.assertEqual(sorted(partitions), list(range(4)))
+        for event in range(1, 6):
+            self.assertEqual(len(set(partition(m, 4) for m in messages
+                        if m['event'] == event)), 1)
+        self.assertEqual(
+            sorted(partition(m, 4) for m in messages if not m['event']),
+            list(range(4)))
+
+    def test_domain_limits_processes(self):
+        'Test the limits of the domains are shared by the processes'
+        if not config.has_section('calendar_scheduling'):
+            config.add_section('calendar_scheduling')
+        config.set('calendar_scheduling', 'domain_rate', '10')
+        config.set('calendar_scheduling', 'domain_concurrency', '4')
+        try:
+            scheduler = delivery.DomainScheduler(processes=4)
+            self.assertEqual(scheduler.rate('example.com'), 2.5)
+            self.assertEqual(scheduler.concurrency('example.com'), 1)
+            scheduler = delivery.DomainScheduler(processes=8)
+            self.assertEqual(scheduler.concurrency('example.com'), 1)
+        finally:
+            config.remove_option('calendar_scheduling', 'domain_rate')
+            config.remove_option('calendar_scheduling', 'domain_concurrency')
+
+    def test_metrics_autodump(self):
+        'Test the metrics are dumped by any process at most every interval'
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'metrics.prom')
+        if not config.has_section('calendar_scheduling'):
+            config.add_section('calendar_scheduling')
+        config.set('calendar_scheduling', 'metrics_file', path)
+        config.set('calendar_scheduling', 'metrics_interval', '3600')
+        metrics._dumped = None
+        try:
+            with metrics.timer('test'):
+                pass
+            with open(path) as file_:
+                self.assertIn('phase="test"', file_.read())
+            os.remove(path)
+            with metrics.timer('test'):
+                pass
+            self.assertFalse(os.path.exists(path))
+            metrics.autodump(force=True)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            config.remove_option('calendar_scheduling', 'metrics_file')
+            config.remove_option('calendar_scheduling', 'metrics_interval')
+            if os.path.exists(path):
+                os.remove(path)
+            os.rmdir(directory)
+
+    @with_transaction()
+    def test_outbox_lock_pending(self):
+        'Test outbox processes only the messages still pending'
+        Outbox = Pool().get('calendar.scheduling.outbox')
+
+        messages = []
+        for event in create_events(3):
+            messages.append(Outbox.enqueue('new', 'REQUEST',
+                    'organizer@example.com',
+                    [a.email for a in event.attendees], event=event,
+                    owner=event.calendar.owner, merge=False))
+        ids = [m.id for m in messages]
+        # Sent and deleted by another process
+        Outbox.write(messages[:1], {'state': 'sent'})
+        Outbox.delete(messages[1:2])
+
+        messages = Outbox.browse(ids)
+        self.assertEqual(Outbox.lock_pending(messages), messages[2:])
+        server = SMTPServer()
+        Outbox.process(messages, server=server)
+        self.assertEqual(len(server.messages), 1)
+        self.assertEqual([m.state for m in Outbox.browse(ids[::2])],
+            ['sent', 'sent'])
+
+    def test_build_msg_mime_layout(self):
+        'Test unknown MIME layout keeps the iCalendar parts'
+        ical = vobject.iCalendar()
+        ical.add('method').value = 'REQUEST'
+        if not config.has_section('calendar_scheduling'):
+            config.add_section('calendar_scheduling')
+        config.set('calendar_scheduling', 'mime_layout', 'attachement')
+        try:
+            msg = calendar_.build_msg('organizer@example.com',
+                'attendee@example.com', 'Subject', 'Body', ical)
+        finally:
+            config.remove_option('calendar_scheduling', 'mime_layout')
+        self.assertEqual(
+            [p.get_content_type() for p in msg.walk()
+                if not p.is_multipart()],
+            ['text/plain', 'text/calendar', 'application/ics'])
+
+    @with_transaction()
+    def test_render_cache(self):
+        'Test the rendered messages are cleared on language changes'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Lang = pool.get('ir.lang')
+        Translation = pool.get('ir.translation')
+
+        event, = create_events(1)
+        owner = event.calendar.owner
+        lang, = Lang.search([('code', '=', 'en')])
+        Lang.write([lang], {'date': '%m/%d/%Y'})
+        subject, _ = event.subject_body('new', owner, language='en')
+        self.assertIn('01/01/2017', subject)
+        self.assertIsNotNone(Event._subject_body_cache.get(('new', 'en')))
+
+        Lang.write([lang], {'date': '%Y-%m-%d'})
+        self.assertIsNone(Event._subject_body_cache.get(('new', 'en')))
+        subject, _ = event.subject_body('new', owner, language='en')
+        self.assertIn('2017-01-01', subject)
+
+        Translation.create([{
+                    'name': 'calendar.event',
+                    'lang': 'en',
+                    'type': 'error',
+                    'src': 'Bullet',
+                    'value': 'Bullet',
+                    }])
+        self.assertIsNone(Event._subject_body_cache.get(('new', 'en')))
+
+    @with_transaction()
+    def test_write_schedule_status(self):
+        'Test write stores the schedule status without changing the events'
+        Event = Pool().get('calendar.event')
+
+        event, = create_events(1)
+        sequence = event.sequence
+        with record_sendmail() as messages:
+            Event.write([event], {'summary': 'Changed'})
+        self.assertEqual(len(messages), 1)
+        event = Event(event.id)
+        self.assertEqual(event.sequence, sequence + 1)
+        self.assertEqual(set(a.schedule_status for a in event.attendees),
+            {'1.1'})
+
+    @with_transaction()
+    def test_write_chunk(self):
+        'Test write splits the events into chunks with all their actions'
+        Event = Pool().get('calendar.event')
+
+        events = create_events(5)
+        calls = []
+        write_scheduling = Event.write_scheduling
+
+        def spy(*args):
+            calls.append([[e.id for e in a] for a in args[::2]])
+            write_scheduling(*args)
+        Event.write_scheduling = staticmethod(spy)
+        if not config.has_section('calendar_scheduling'):
+            config.add_section('calendar_scheduling')
+        config.set('calendar_scheduling', 'write_chunk', '2')
+        try:
+            with record_sendmail() as messages:
+                Event.write(events, {'summary': 'Changed'},
+                    [events[0], events[4]], {'location': None,
+                        'description': 'Changed'})
+        finally:
+            config.remove_option('calendar_scheduling', 'write_chunk')
+            del Event.write_scheduling
+
+        ids = [e.id for e in events]
+        self.assertEqual(calls, [
+                [[ids[0], ids[1]], [ids[0]]],
+                [[ids[2], ids[3]]],
+                [[ids[4]], [ids[4]]],
+                ])
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(
+            [(e.summary, e.description) for e in Event.browse(ids)],
+            [('Changed', 'Changed')] + [('Changed', None)] * 3
+            + [('Changed', 'Changed')])
+
+    @with_transaction()
+    def test_write_occurrences(self):
+        'Test write of occurrences sends them with the series'
+        Event = Pool().get('calendar.event')
+
+        parent, = create_events(1)
+        with Transaction().set_user(0):
+            Event.write([parent], {
+                    'rrules': [('create', [{
+                                    'freq': 'daily',
+                                    }])],
+                    })
+            occurrences = Event.create([{
+                        'calendar': parent.calendar.id,
+                        'uuid': parent.uuid,
+                        'parent': parent.id,
+                        'recurrence': datetime.datetime(2017, 1, d, 9),
+                        'summary': parent.summary,
+                        'dtstart': datetime.datetime(2017, 1, d, 9),
+                        'dtend': datetime.datetime(2017, 1, d, 10),
+                        } for d in [2, 3]])
+        with record_sendmail() as messages:
+            Event.write(occurrences, {'summary': 'Changed'})
+
+        (_, to_addrs, msg), = messages
+        self.assertEqual(sorted(to_addrs),
+            sorted(a.email for a in parent.attendees))
+        ical = vobject.readOne(msg.get_payload()[-1].get_payload(
+                decode=True).decode('utf-8'))
+        self.assertEqual(ical.method.value, 'REQUEST')
+        vevents = ical.vevent_list
+        self.assertEqual(len(vevents), 3)
+        self.assertTrue(hasattr(vevents[0], 'rrule'))
+        self.assertEqual(
+            [v.recurrence_id.value.replace(tzinfo=None)
+                for v in vevents[1:]],
+            [o.recurrence for o in occurrences])
+
+    @with_transaction()
+    def test_scheduling_fingerprint(self):
+        'Test scheduling fingerprint ignores the volatile properties'
+        from trytond.modules.calendar_scheduling.calendar_ import \
+            ical_fingerprint
+        Event = Pool().get('calendar.event')
+
+        event, = create_events(1)
+        fingerprint = ical_fingerprint(event.scheduling_ical('REQUEST'))
+        with Transaction().set_user(0):
+            Event.write([event], {'summary': event.summary})
+        event = Event(event.id)
+        self.assertEqual(
+            ical_fingerprint(event.scheduling_ical('REQUEST')), fingerprint)
+        with Transaction().set_user(0):
+            Event.write([event], {'summary': 'Changed'})
+        event = Event(event.id)
+        self.assertNotEqual(
+            ical_fingerprint(event.scheduling_ical('REQUEST')), fingerprint)
+
+    @with_transaction()
+    def test_spool(self):
+        'Test spool sends the messages only when committed'
+        transaction = Transaction()
+        server = SMTPServer()
+        smtp_server = spool.get_smtp_server
+        spool.get_smtp_server = lambda: server
+        try:
+            spool.Spool().put('organizer@example.com',
+                ['attendee0@example.com'], MIMEText('Rollback'))
+            transaction.rollback()
+            self.assertEqual(server.messages, [])
+
+            spool.Spool().put('organizer@example.com',
+                ['attendee1@example.com'], MIMEText('Commit'))
+            self.assertEqual(server.messages, [])
+            transaction.commit()
+        finally:
+            spool.get_smtp_server = smtp_server
+        (_, to_addrs, msg), = server.messages
+        self.assertEqual(to_addrs, ['attendee1@example.com'])
+        self.assertIn('Commit', msg)
+
+    @with_transaction()
+    def test_defer_scheduling(self):
+        'Test deferred invitation followed by a deletion sends nothing'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Outbox = pool.get('calendar.scheduling.outbox')
+
+        with Transaction().set_context(defer_scheduling=True):
+            events = create_events(2, notify=True)
+            self.assertEqual(Outbox.search_count([
+                        ('state', '=', 'deferred'),
+                        ]), 2)
+            Event.delete(events[:1])
+        deferred = Outbox.search([
+                ('state', '=', 'deferred'),
+                ])
+        self.assertEqual([m.event for m in deferred], events[1:])
+
+        server = SMTPServer()
+        Outbox.replay(server=server)
+        self.assertEqual(len(server.messages), 1)
+        self.assertEqual(Outbox(deferred[0].id).state, 'sent')
+
+    @with_transaction()
+    def test_calendar_notification_index(self):
+        'Test notification index is normalized and cleared on user write'
+        User = Pool().get('res.user')
+
+        user, = User.create([{
+                    'login': 'indexed',
+                    'name': 'Indexed',
+                    'email': 'Indexed@Example.com',
+                    }])
+        index = User.calendar_notification_index([' indexed@example.COM'])
+        (user_id, _, flags), = index.values()
+        self.assertEqual(user_id, user.id)
+        self.assertTrue(flags['update'])
+
+        User.write([user], {
+                'calendar_email_notification_update': False,
+                })
+        index = User.calendar_notification_index(['indexed@example.com'])
+        self.assertFalse(index['indexed@example.com'][2]['update'])
+
+        # The emails are matched exactly
+        User.create([{
+                    'login': 'wildcard',
+                    'name': 'Wildcard',
+                    'email': 'wild_card@example.com',
+                    }])
+        index = User.calendar_notification_index(['wildxcard@example.com'])
+        self.assertEqual(index, {'wildxcard@example.com': None})
+
+    @with_transaction()
+    def test_freebusy(self):
+        'Test free/busy of the owner from the busy periods index'
+        BusyPeriod = Pool().get('calendar.scheduling.busy')
+
+        create_events(2)
+        busy = BusyPeriod.freebusy(
+            ['organizer@example.com', 'unknown@example.com'],
+            datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 2))
+        self.assertEqual(busy, {
+                'organizer@example.com': [(
+                        datetime.datetime(2017, 1, 1, 9),
+                        datetime.datetime(2017, 1, 1, 10),
+                        'BUSY')],
+                })
+
+    @with_transaction()
+    def test_freebusy_index(self):
+        'Test the busy periods are indexed only when they may change'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Attendee = pool.get('calendar.event.attendee')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
+
+        indexed = []
+        index_events = BusyPeriod.index_events
+
+        def spy(events):
+            indexed.extend(e.id for e in events)
+            index_events(events)
+        BusyPeriod.index_events = staticmethod(spy)
+        try:
+            with record_sendmail():
+                events = create_events(2, notify=True)
+                self.assertEqual(indexed, [e.id for e in events])
+
+                del indexed[:]
+                with Transaction().set_user(0):
+                    Attendee.write(list(events[0].attendees), {
+                            'schedule_status': '1.1',
+                            })
+                Event.write_organizer_schedule_status({events[0]: '1.1'})
+                Event.write(events, {'summary': 'Changed'})
+                self.assertEqual(indexed, [])
+
+                Event.write(events[:1], {
+                        'dtend': datetime.datetime(2017, 1, 1, 11),
+                        })
+                self.assertEqual(indexed, [events[0].id])
+        finally:
+            BusyPeriod.index_events = classmethod(index_events.__func__)
+        busy = BusyPeriod.freebusy(['organizer@example.com'],
+            datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 2))
+        self.assertEqual(busy, {
+                'organizer@example.com': [(
+                        datetime.datetime(2017, 1, 1, 9),
+                        datetime.datetime(2017, 1, 1, 11),
+                        'BUSY')],
+                })
+
+    @with_transaction()
+    def test_freebusy_expand_series(self):
+        'Test the series are expanded again near the end of the horizon'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
+        table = Event.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if not config.has_section('calendar_scheduling'):
+            config.add_section('calendar_scheduling')
+        config.set('calendar_scheduling', 'freebusy_horizon', '10')
+        now = datetime.datetime.now()
+        try:
+            series, finite, single = create_events(3)
+            with Transaction().set_user(0):
+                Event.write([series], {
+                        'rrules': [('create', [{
+                                        'freq': 'daily',
+                                        }])],
+                        }, [finite], {
+                        'rrules': [('create', [{
+                                        'freq': 'daily',
+                                        'count': 3,
+                                        }])],
+                        })
+            busy_until = Event(series.id).busy_until
+            self.assertGreaterEqual(busy_until,
+                now + datetime.timedelta(days=10))
+            self.assertEqual([Event(e.id).busy_until
+                    for e in [finite, single]], [None, None])
+
+            # The series has been indexed 20 days ago
+            cursor.execute(*table.update(
+                    columns=[table.busy_until],
+                    values=[busy_until - datetime.timedelta(days=20)],
+                    where=table.id == series.id))
+            BusyPeriod.expand_series()
+        finally:
+            config.remove_option('calendar_scheduling', 'freebusy_horizon')
+        self.assertGreaterEqual(Event(series.id).busy_until, busy_until)
+        periods = BusyPeriod.search([('event', '=', series.id)],
+            order=[('start', 'ASC')])
+        self.assertGreaterEqual(periods[-1].start,
+            now + datetime.timedelta(days=9))
+
+    @with_transaction()
+    def test_freebusy_access(self):
+        'Test free/busy is returned only for the readable calendars'
+        pool = Pool()
+        User = pool.get('res.user')
+        Calendar = pool.get('calendar.calendar')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
+
+        event, = create_events(1)
+        user, = User.create([{
+                    'login': 'user',
+                    'name': 'User',
+                    }])
+        emails = ['organizer@example.com']
+        start, end = (datetime.datetime(2017, 1, 1),
+            datetime.datetime(2017, 1, 2))
+
+        def freebusy():
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(_check_access=True):
+                return BusyPeriod.freebusy(emails, start, end)
+        self.assertEqual(freebusy(), {})
+        Calendar.write([event.calendar], {
+                'read_users': [('add', [user.id])],
+                })
+        self.assertEqual(list(freebusy()), emails)
+
+    @with_transaction()
+    def test_freebusy_index_access(self):
+        'Test the busy periods are indexed for the users without access'
+        pool = Pool()
+        User = pool.get('res.user')
+        Calendar = pool.get('calendar.calendar')
+        Event = pool.get('calendar.event')
+        Attendee = pool.get('calendar.event.attendee')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
+
+        user, = User.create([{
+                    'login': 'user',
+                    'name': 'User',
+                    'email': 'user@example.com',
+                    }])
+        calendar, = Calendar.create([{
+                    'name': 'user',
+                    'owner': user.id,
+                    }])
+        with Transaction().set_user(user.id), \
+                Transaction().set_context(_check_access=True), \
+                record_sendmail():
+            event, = Event.create([{
+                        'calendar': calendar.id,
+                        'uuid': str(uuid.uuid4()),
+                        'summary': 'Event',
+                        'dtstart': datetime.datetime(2017, 1, 1, 9),
+                        'dtend': datetime.datetime(2017, 1, 1, 10),
+                        'organizer': 'organizer@example.com',
+                        'attendees': [('create', [{
+                                        'email': 'user@example.com',
+                                        }])],
+                        }])
+            Event.write([event], {
+                    'dtend': datetime.datetime(2017, 1, 1, 11),
+                    })
+            Attendee.write(list(event.attendees), {'status': 'declined'})
+            Attendee.write(list(event.attendees), {'status': 'accepted'})
+        period, = BusyPeriod.search([('event', '=', event.id)])
+        self.assertEqual((period.end, period.fbtype),
+            (datetime.datetime(2017, 1, 1, 11), 'BUSY'))
+
+    @with_transaction()
+    def test_freebusy_index_delete(self):
+        'Test the busy periods are updated on deletions'
+        pool = Pool()
+        User = pool.get('res.user')
+        Calendar = pool.get('calendar.calendar')
+        Event = pool.get('calendar.event')
+        Attendee = pool.get('calendar.event.attendee')
+        BusyPeriod = pool.get('calendar.scheduling.busy')
+
+        day = datetime.datetime.combine(
+            datetime.date.today() + datetime.timedelta(days=1),
+            datetime.time(9))
+        hour = datetime.timedelta(hours=1)
+
+        def freebusy(email):
+            return BusyPeriod.freebusy([email], day, day + 24 * hour)[email]
+
+        def busy_until(event):
+            # With the cache of the user indexing
+            with Transaction().set_user(0):
+                return Event(event.id).busy_until
+
+        series, = create_events(1)
+        self.assertIsNone(busy_until(series))
+        with Transaction().set_user(0):
+            Event.write([series], {
+                    'dtstart': day - 24 * hour,
+                    'dtend': day - 23 * hour,
+                    'rrules': [('create', [{
+                                    'freq': 'daily',
+                                    }])],
+                    })
+            self.assertIsNotNone(busy_until(series))
+            occurrence, = Event.create([{
+                        'calendar': series.calendar.id,
+                        'uuid': series.uuid,
+                        'parent': series.id,
+                        'recurrence': day,
+                        'summary': series.summary,
+                        'dtstart': day + 5 * hour,
+                        'dtend': day + 6 * hour,
+                        }])
+        self.assertEqual(freebusy('organizer@example.com'),
+            [(day + 5 * hour, day + 6 * hour, 'BUSY')])
+        with record_sendmail():
+            Event.delete([occurrence])
+        self.assertEqual(freebusy('organizer@example.com'),
+            [(day, day + hour, 'BUSY')])
+
+        user, = User.create([{
+                    'login': 'user',
+                    'name': 'User',
+                    'email': 'user@example.com',
+                    }])
+        calendar, = Calendar.create([{
+                    'name': 'user',
+                    'owner': user.id,
+                    }])
+        with Transaction().set_user(0):
+            event, = Event.create([{
+                        'calendar': calendar.id,
+                        'uuid': str(uuid.uuid4()),
+                        'summary': 'Declined',
+                        'dtstart': day,
+                        'dtend': day + hour,
+                        'organizer': 'organizer@example.com',
+                        'attendees': [('create', [{
+                                        'email': 'user@example.com',
+                                        'status': 'declined',
+                                        }])],
+                        }])
+        self.assertEqual(freebusy('user@example.com'), [])
+        Attendee.delete(list(event.attendees))
+        self.assertEqual(freebusy('user@example.com'),
+            [(day, day + hour, 'BUSY')])
+
+    @with_transaction()
+    def test_imip_ingest(self):
+        'Test ingestion of iMIP replies from a mbox'
+        from trytond.modules.calendar_scheduling import imip
+        Event = Pool().get('calendar.event')
+
+        event, = create_events(1)
+        path = reply_mbox(event.uuid)
+        try:
+            self.assertEqual(imip.ingest(path), 1)
+        finally:
+            os.remove(path)
+        attendee, = [a for a in Event(event.id).attendees
+            if a.email == 'attendee0@example.com']
+        self.assertEqual(attendee.status, 'accepted')
+        self.assertEqual(attendee.schedule_status, '1.2')
+
+    @with_transaction()
+    def test_imip_ingest_occurrence(self):
+        'Test iMIP reply to an occurrence not stored creates it'
+        from trytond.modules.calendar_scheduling import imip
+        Event = Pool().get('calendar.event')
+
+        series, = create_events(1)
+        with Transaction().set_user(0):
+            Event.write([series], {
+                    'rrules': [('create', [{
+                                    'freq': 'daily',
+                                    }])],
+                    })
+        path = reply_mbox(series.uuid, recurrence='20170102T090000')
+        try:
+            self.assertEqual(imip.ingest(path), 1)
+        finally:
+            os.remove(path)
+
+        occurrence, = Event(series.id).occurences
+        self.assertEqual(occurrence.uuid, series.uuid)
+        self.assertEqual(occurrence.recurrence,
+            datetime.datetime(2017, 1, 2, 9))
+        self.assertEqual(occurrence.dtstart,
+            datetime.datetime(2017, 1, 2, 9))
+        self.assertEqual(occurrence.dtend,
+            datetime.datetime(2017, 1, 2, 10))
+        self.assertEqual(
+            dict((a.email, a.status) for a in occurrence.attendees),
+            dict((a.email, 'accepted' if a.email == 'attendee0@example.com'
+                    else a.status) for a in series.attendees))
+        attendee, = [a for a in Event(series.id).attendees
+            if a.email == 'attendee0@example.com']
+        self.assertNotEqual(attendee.status, 'accepted')
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -0,0 +1,102 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Render and send the pending messages of the outbox with a pool of processes
+
+The messages are partitioned by event, so the messages of an event are sent
+in order by the same process:
+
+    python -m trytond.modules.calendar_scheduling.worker -d DATABASE -p 4
+
+The messages are locked by the transaction sending them, so the cron task of
+the outbox can run at the same time on PostgreSQL. The rate and concurrency
+limits of the domains are shared by the processes.
+'''
+from argparse import ArgumentParser
+import datetime
+import multiprocessing
+import time
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['partition', 'work', 'run']
+
+
+def partition(message, processes):
+    "Return the index of the process sending the message"
+    return (message['event'] or message['id']) % processes
+
+
+def work(args):
+    '''
+    Send the pending messages of the partition index and return the index,
+    the number of messages and the duration
+    '''
+    database, index, processes = args
+    start = time.time()
+    Pool.start()
+    Pool(database).init()
+    with Transaction().start(database, 0):
+        Outbox = Pool().get('calendar.scheduling.outbox')
+        messages = Outbox.search_read([
+                ('state', '=', 'pending'),
+                ['OR',
+                    ('send_after', '=', None),
+                    ('send_after', '<=', datetime.datetime.now()),
+                    ],
+                ], fields_names=['event'])
+        ids = [m['id'] for m in messages
+            if partition(m, processes) == index]
+
+    size = config.getint('calendar_scheduling', 'batch_size', default=1000)
+    for sub_ids in grouped_slice(ids, size):
+        with Transaction().start(database, 0) as transaction:
+            Outbox = Pool().get('calendar.scheduling.outbox')
+            # The messages sent or deleted since are skipped by process
+            Outbox.process(Outbox.browse(list(sub_ids)), processes=processes)
+            transaction.commit()
+    return index, len(ids), time.time() - start
+
+
+def run(database, processes):
+    '''
+    Send the pending messages with processes and return the list of
+    (index, messages, duration) per process
+    '''
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        return pool.map(work,
+            [(database, i, processes) for i in range(processes)])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(database, processes):
+    start = time.time()
+    results = run(database, processes)
+    duration = time.time() - start
+
+    print('%-8s %10s %10s %10s' % ('process', 'messages', 's', 'msg/s'))
+    for index, number, seconds in results:
+        print('%-8d %10d %10.1f %10.1f' % (
+                index, number, seconds, number / seconds if seconds else 0))
+    total = sum(r[1] for r in results)
+    print('%-8s %10d %10.1f %10.1f' % (
+            'total', total, duration, total / duration if duration else 0))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config',
+        help='specify config file')
+    parser.add_argument('-d', '--database', dest='database', required=True,
+        help='database name')
+    parser.add_argument('-p', '--processes', dest='processes', type=int,
+        default=multiprocessing.cpu_count(), help='number of processes')
+    options = parser.parse_args()
+    config.update_etc(options.config)
+    main(options.database, options.processes)